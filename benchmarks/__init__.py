@@ -0,0 +1,77 @@
+"""
+Benchmarks for the polls hot paths
+
+Each module can be run on its own, for example::
+
+    python -m benchmarks.results
+    python -m benchmarks.harness --polls 10000 --choices 5
+
+They run against a fresh test database so they never touch
+database/mysite.db. With SQLite the test database is a file so that
+a real WSGI server in another thread can share it.
+"""
+import os
+import tempfile
+import time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+
+def setup(database=None):
+    """
+    Creates the test database and installs the test environment.
+    Votes are not rate limited or deduplicated while benchmarking.
+    """
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    if connection.vendor == 'sqlite':
+        settings.DATABASES['default']['TEST_NAME'] = database or os.path.join(
+            tempfile.gettempdir(), 'polls_benchmark.db')
+    settings.POLLS_RATE_LIMIT_CLIENT = None
+    settings.POLLS_RATE_LIMIT_POLL = None
+    settings.POLLS_DEDUPE_VOTES = False
+    setup_test_environment()
+    # a database left behind by an interrupted run is replaced instead
+    # of asking whether to delete it
+    return connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+
+def teardown(old_name):
+    from django.db import connection
+    from django.test.utils import teardown_test_environment
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+    teardown_test_environment()
+
+
+def summarize(times, elapsed):
+    """
+    p50 and p99 latencies in milliseconds and requests a second
+    for a list of request ``times`` in seconds
+    """
+    times = sorted(times)
+    return {
+        'p50': times[len(times) // 2] * 1000,
+        'p99': times[min(len(times) - 1, int(len(times) * 0.99))] * 1000,
+        'rps': len(times) / elapsed if elapsed else None,
+    }
+
+
+def measure(func, repeat=50):
+    """
+    Calls ``func`` ``repeat`` times and returns the p50 and p99
+    latencies in milliseconds, the calls a second and the number
+    of queries per call
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    times = []
+    with CaptureQueriesContext(connection) as queries:
+        begin = time.time()
+        for i in range(repeat):
+            start = time.time()
+            func(i)
+            times.append(time.time() - start)
+        elapsed = time.time() - begin
+    result = summarize(times, elapsed)
+    result['queries'] = float(len(queries)) / repeat
+    return result
@@ -0,0 +1,219 @@
+"""
+Load test for the polls hot paths
+
+Builds a synthetic dataset, then drives IndexView, DetailView GET and
+POST and ResultsView through the Django test client and through
+``mysite.wsgi.application`` served by a real WSGI server. The p50 and
+p99 latencies, requests a second and (for the test client) queries per
+request are written to a JSON report::
+
+    python -m benchmarks.harness --polls 100000 --choices 4 \\
+        --output report.json
+
+``--baseline`` compares the run with an earlier report and exits with
+status 1 if a latency got more than ``--threshold`` worse or a view
+started running more queries.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import urllib2
+from optparse import OptionParser
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from benchmarks import setup, teardown, measure, summarize
+
+SCENARIOS = ('index', 'detail', 'vote', 'results')
+
+
+def make_dataset(num_polls, num_choices, seed=0):
+    """
+    ``num_polls`` published polls with ``num_choices`` choices each
+    """
+    from polls.generate import generate
+    from polls.models import Poll
+    generate(num_polls, seed=seed, future=0, sparse=0,
+        min_choices=num_choices, max_choices=num_choices)
+    return list(Poll.objects.values_list('id', flat=True))
+
+
+def targets(poll_ids, sample, seed=0):
+    """
+    ``sample`` random polls with the id of one of their choices
+    """
+    from polls.models import Choice
+    rng = random.Random(seed)
+    picked = rng.sample(poll_ids, min(sample, len(poll_ids)))
+    choice_ids = dict(Choice.objects.filter(poll__in=picked).values_list(
+        'poll', 'id'))
+    return [(poll_id, choice_ids[poll_id]) for poll_id in picked]
+
+
+def urls(scenario, target):
+    from django.core.urlresolvers import reverse
+    poll_id, choice_id = target
+    if scenario == 'index':
+        return reverse('polls:index'), None
+    if scenario == 'results':
+        return reverse('polls:results', args=(poll_id,)), None
+    data = {'choice': choice_id} if scenario == 'vote' else None
+    return reverse('polls:detail', args=(poll_id,)), data
+
+
+def run_client(polls, requests):
+    from django.test.client import Client
+    client = Client()
+    report = {}
+    for scenario in SCENARIOS:
+        def request(i):
+            url, data = urls(scenario, polls[i % len(polls)])
+            if data is None:
+                client.get(url)
+            else:
+                client.post(url, data)
+        report[scenario] = measure(request, requests)
+    return report
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def run_wsgi(polls, requests, concurrency):
+    from django.utils.http import urlencode
+    from mysite.wsgi import application
+    server = make_server('127.0.0.1', 0, application,
+        handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%s' % server.server_port
+    opener = urllib2.build_opener()
+    # a CSRF cookie and token to vote with
+    response = opener.open(base + urls('detail', polls[0])[0])
+    csrf = [c.split('=', 1)[1].split(';')[0]
+        for c in response.info().getheaders('Set-Cookie')
+        if c.startswith('csrftoken=')][0]
+    report = {}
+    try:
+        for scenario in SCENARIOS:
+            times = []
+            lock = threading.Lock()
+
+            def worker(offset):
+                for i in range(offset, requests, concurrency):
+                    url, data = urls(scenario, polls[i % len(polls)])
+                    request = urllib2.Request(base + url)
+                    if data is not None:
+                        request.add_data(urlencode(data))
+                        request.add_header('Cookie', 'csrftoken=%s' % csrf)
+                        request.add_header('X-CSRFToken', csrf)
+                    start = time.time()
+                    try:
+                        opener.open(request).read()
+                    except urllib2.HTTPError as e:
+                        # the redirect after a vote
+                        e.read()
+                    with lock:
+                        times.append(time.time() - start)
+
+            workers = [threading.Thread(target=worker, args=(offset,))
+                for offset in range(concurrency)]
+            begin = time.time()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            report[scenario] = summarize(times, time.time() - begin)
+            report[scenario]['queries'] = None
+    finally:
+        server.shutdown()
+    return report
+
+
+def compare(report, baseline, threshold):
+    """
+    Returns a list of regressions of ``report`` against ``baseline``
+    """
+    regressions = []
+    for mode, views in report['results'].items():
+        for view, result in views.items():
+            old = baseline.get('results', {}).get(mode, {}).get(view)
+            if old is None:
+                continue
+            for stat in ('p50', 'p99'):
+                if result[stat] > old[stat] * (1 + threshold):
+                    regressions.append("%s %s %s %.2fms -> %.2fms" % (
+                        mode, view, stat, old[stat], result[stat]))
+            if (result['queries'] is not None and old['queries'] is not None
+                    and result['queries'] > old['queries']):
+                regressions.append("%s %s queries %s -> %s" % (
+                    mode, view, old['queries'], result['queries']))
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.harness [options]")
+    parser.add_option('--polls', type='int', default=1000)
+    parser.add_option('--choices', type='int', default=4)
+    parser.add_option('--requests', type='int', default=500,
+        help='requests per view')
+    parser.add_option('--sample', type='int', default=100,
+        help='how many different polls the requests go to')
+    parser.add_option('--concurrency', type='int', default=8,
+        help='parallel clients against the WSGI server')
+    parser.add_option('--mode', choices=['client', 'wsgi', 'both'],
+        default='both')
+    parser.add_option('--output', default='benchmark.json')
+    parser.add_option('--baseline', default=None,
+        help='an earlier report to compare with')
+    parser.add_option('--threshold', type='float', default=0.2,
+        help='allowed slowdown before a latency is a regression')
+    options, args = parser.parse_args(argv)
+
+    old_name = setup()
+    try:
+        start = time.time()
+        poll_ids = make_dataset(options.polls, options.choices)
+        polls = targets(poll_ids, options.sample)
+        report = {
+            'dataset': {
+                'polls': options.polls,
+                'choices': options.choices,
+                'seconds': time.time() - start,
+            },
+            'requests': options.requests,
+            'results': {},
+        }
+        if options.mode in ('client', 'both'):
+            report['results']['client'] = run_client(polls, options.requests)
+        if options.mode in ('wsgi', 'both'):
+            report['results']['wsgi'] = run_wsgi(
+                polls, options.requests, options.concurrency)
+    finally:
+        teardown(old_name)
+
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    for mode, views in sorted(report['results'].items()):
+        for view, result in sorted(views.items()):
+            print("%-6s %-8s p50 %8.2fms p99 %8.2fms %8.1f req/s %s" % (
+                mode, view, result['p50'], result['p99'], result['rps'],
+                '' if result['queries'] is None else
+                '%.1f queries' % result['queries']))
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(report, json.load(baseline),
+                options.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
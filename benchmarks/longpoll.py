@@ -0,0 +1,135 @@
+"""
+Throughput with many idle connections, threads against gevent
+
+Opens ``--idle`` long polls on ``results.json?wait=`` and measures the
+index, detail and results pages from ``--clients`` busy clients at the
+same time. Run it once per server and compare::
+
+    python -m benchmarks.longpoll --server threads --idle 1000
+    python -m benchmarks.longpoll --server gevent --idle 1000
+
+``threads`` is a thread per connection like a sync worker, ``gevent``
+serves ``mysite.green`` with a greenlet per connection.
+"""
+import sys
+import time
+from optparse import OptionParser
+
+
+def start_server(kind, application):
+    import threading
+    if kind == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(('127.0.0.1', 0), application, log=None)
+        server.start()
+        return server.server_port, server.stop
+    from SocketServer import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, make_server
+    from benchmarks.harness import QuietHandler
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 2048
+
+    server = make_server('127.0.0.1', 0, application,
+        server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_port, server.shutdown
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.longpoll [options]")
+    parser.add_option('--server', choices=['threads', 'gevent'],
+        default='threads')
+    parser.add_option('--idle', type='int', default=1000,
+        help='long polls held open')
+    parser.add_option('--clients', type='int', default=10,
+        help='clients loading pages as fast as they can')
+    parser.add_option('--seconds', type='float', default=10)
+    options, args = parser.parse_args(argv)
+    if options.server == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    import random
+    import threading
+    import urllib2
+    from benchmarks import setup, teardown, summarize
+    old_name = setup()
+    from django.conf import settings
+    from django.core.urlresolvers import reverse
+    from polls.generate import generate
+    from polls.models import Poll
+    if options.server == 'gevent':
+        from mysite.green import application
+    else:
+        from mysite.wsgi import application
+    settings.POLLS_LONG_POLL_TIMEOUT = options.seconds * 2
+    generate(100, future=0, sparse=0)
+    poll_ids = list(Poll.objects.values_list('id', flat=True))
+    port, stop_server = start_server(options.server, application)
+    base = 'http://127.0.0.1:%s' % port
+    stop = time.time() + options.seconds
+    errors = []
+
+    def get(url, headers=None):
+        request = urllib2.Request(base + url, headers=headers or {})
+        try:
+            return urllib2.urlopen(request, timeout=options.seconds * 3)
+        except urllib2.HTTPError as e:
+            # 304 for a long poll that timed out
+            return e
+
+    def idle(poll_id):
+        url = reverse('polls:results_json', args=(poll_id,))
+        try:
+            etag = get(url).info()['ETag']
+            while time.time() < stop:
+                get(url + '?wait=%s' % options.seconds,
+                    {'If-None-Match': etag}).read()
+        except Exception as e:
+            errors.append(e)
+
+    times = []
+
+    def busy(seed):
+        rng = random.Random(seed)
+        while time.time() < stop:
+            poll_id = rng.choice(poll_ids)
+            url = rng.choice([reverse('polls:index'),
+                reverse('polls:detail', args=(poll_id,)),
+                reverse('polls:results', args=(poll_id,))])
+            start = time.time()
+            try:
+                get(url).read()
+            except Exception as e:
+                errors.append(e)
+                continue
+            times.append(time.time() - start)
+
+    threads = [threading.Thread(target=idle, args=(random.choice(poll_ids),))
+        for i in range(options.idle)]
+    threads += [threading.Thread(target=busy, args=(i,))
+        for i in range(options.clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(max(stop - time.time(), 0))
+    stop_server()
+    teardown(old_name)
+
+    if not times:
+        print("%s: no page was served, %s errors" % (
+            options.server, len(errors)))
+        return 1
+    result = summarize(times, options.seconds)
+    print("%s: %s idle connections, %.1f pages/s, p50 %.2fms, "
+        "p99 %.2fms, %s errors" % (options.server, options.idle,
+            result['rps'], result['p50'], result['p99'], len(errors)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""
+Times VoteRateLimitMiddleware on its own, the budget is 100 microseconds
+a request
+
+    python -m benchmarks.ratelimit
+"""
+import sys
+import time
+from benchmarks import setup, teardown
+
+BUDGET = 100
+REQUESTS = 20000
+
+
+def main():
+    old_name = setup()
+    from django.core.urlresolvers import resolve, reverse
+    from django.test.client import RequestFactory
+    from django.test.utils import override_settings
+    from polls.middleware import VoteRateLimitMiddleware
+    # setup() turns rate limiting off, this benchmark needs it on
+    with override_settings(POLLS_RATE_LIMIT_CLIENT=(10, 60),
+            POLLS_RATE_LIMIT_POLL=(1000, 1)):
+        middleware = VoteRateLimitMiddleware()
+    url = reverse('polls:detail', args=(1,))
+    match = resolve(url)
+    factory = RequestFactory()
+    requests = []
+    for i in range(REQUESTS):
+        request = factory.post(url, {'choice': 1},
+            REMOTE_ADDR='10.%s.%s.%s' % (i // 65536, i // 256 % 256, i % 256))
+        request.resolver_match = match
+        requests.append(request)
+    start = time.time()
+    for request in requests:
+        middleware.process_view(request, match.func, match.args, match.kwargs)
+    per_request = (time.time() - start) * 1e6 / REQUESTS
+    print("%.1f microseconds a request (budget %s)" % (per_request, BUDGET))
+    teardown(old_name)
+    return 0 if per_request < BUDGET else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""
+Times ResultsView for polls with 10, 100 and 1000 choices
+
+    python -m benchmarks.results
+"""
+import random
+from benchmarks import setup, teardown, measure
+
+SIZES = (10, 100, 1000)
+
+
+def create_poll(num_choices):
+    from django.utils import timezone
+    from polls.models import Poll, Choice
+    poll = Poll.objects.create(question="%s choices" % num_choices,
+        pub_date=timezone.now(), choice_count=num_choices)
+    Choice.objects.bulk_create([
+        Choice(poll=poll, choice_text="choice %s" % i,
+            votes=random.randint(0, 1000))
+        for i in range(num_choices)])
+    return poll
+
+
+def main():
+    old_name = setup()
+    from django.core.urlresolvers import reverse
+    from django.test.client import Client
+    client = Client()
+    random.seed(0)
+    print("%8s %10s %10s %8s" % ("choices", "p50 ms", "p99 ms", "queries"))
+    for num_choices in SIZES:
+        url = reverse('polls:results', args=(create_poll(num_choices).id,))
+        result = measure(lambda i: client.get(url))
+        print("%8s %10.2f %10.2f %8s" % (num_choices,
+            result['p50'], result['p99'], result['queries']))
+    teardown(old_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Concurrent votes and reads on SQLite with and without the production
+profile in mysite/settings_production.py
+
+    python -m benchmarks.sqlite --writers 4 --readers 16 --seconds 10
+
+"before" is the default journal, full syncs and a new connection for
+every request. "after" is WAL, synchronous=NORMAL, mmap and persistent
+connections.
+"""
+import random
+import sys
+import threading
+import time
+from optparse import OptionParser
+from benchmarks import setup, teardown, summarize
+
+PROFILES = (
+    ('before', (('journal_mode', 'DELETE'), ('synchronous', 'FULL'),
+        ('mmap_size', 0), ('busy_timeout', 5000)), False),
+    ('after', None, True),
+)
+
+
+def run(poll_ids, choice_ids, writers, readers, seconds, persistent):
+    from django.db import connection, OperationalError
+    from polls.models import Poll, Choice
+    stop = time.time() + seconds
+    lock = threading.Lock()
+    stats = {'vote': [], 'read': [], 'errors': 0}
+
+    def worker(kind, seed):
+        rng = random.Random(seed)
+        times = []
+        errors = 0
+        while time.time() < stop:
+            start = time.time()
+            try:
+                if kind == 'vote':
+                    Choice.objects.get(pk=rng.choice(choice_ids)).record_vote()
+                else:
+                    Poll.objects.get(pk=rng.choice(poll_ids)).results()
+                    list(Poll.objects.published()[:5])
+            except OperationalError:
+                errors += 1
+            times.append(time.time() - start)
+            if not persistent:
+                # what CONN_MAX_AGE = 0 does at the end of a request
+                connection.close()
+        connection.close()
+        with lock:
+            stats[kind].extend(times)
+            stats['errors'] += errors
+
+    threads = [threading.Thread(target=worker, args=('vote', i))
+        for i in range(writers)]
+    threads += [threading.Thread(target=worker, args=('read', writers + i))
+        for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'vote': summarize(stats['vote'], seconds),
+        'read': summarize(stats['read'], seconds),
+        'errors': stats['errors'],
+    }
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.sqlite [options]")
+    parser.add_option('--polls', type='int', default=1000)
+    parser.add_option('--writers', type='int', default=4)
+    parser.add_option('--readers', type='int', default=16)
+    parser.add_option('--seconds', type='float', default=10)
+    options, args = parser.parse_args(argv)
+
+    old_name = setup()
+    from django.conf import settings
+    from django.db import connection
+    from polls.generate import generate
+    from polls.models import Poll, Choice
+    from mysite import settings_production
+    if connection.vendor != 'sqlite':
+        print("This benchmark needs SQLite")
+        teardown(old_name)
+        return 1
+    try:
+        generate(options.polls, future=0, sparse=0)
+        poll_ids = list(Poll.objects.values_list('id', flat=True))
+        choice_ids = list(Choice.objects.values_list('id', flat=True))
+        connection.close()
+        for name, pragmas, persistent in PROFILES:
+            settings.POLLS_SQLITE_PRAGMAS = (pragmas if pragmas is not None
+                else settings_production.POLLS_SQLITE_PRAGMAS)
+            result = run(poll_ids, choice_ids, options.writers,
+                options.readers, options.seconds, persistent)
+            connection.close()
+            print("%-6s votes %7.1f/s p99 %7.2fms  reads %7.1f/s p99 %7.2fms"
+                "  %s locked" % (name,
+                result['vote']['rps'], result['vote']['p99'],
+                result['read']['rps'], result['read']['p99'],
+                result['errors']))
+    finally:
+        settings.POLLS_SQLITE_PRAGMAS = ()
+        teardown(old_name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""
+Entry point for serving mysite from gevent
+
+Every request runs in a greenlet instead of a thread, so the requests
+that mostly wait (result streams, ``results.json?wait=`` long polls and
+slow clients) cost a little memory each instead of a worker thread.
+The sockets, sleeps and locks they wait on are patched to yield to
+other greenlets. psycopg2 queries yield too when psycogreen is
+installed. SQLite queries still block, but they are short.
+
+    gunicorn -k gevent --worker-connections 1000 mysite.green:application
+    python -m mysite.green 8000
+
+Needs gevent, which is not in requirements.txt since mysite.wsgi
+doesn't use it.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    pass
+else:
+    patch_psycopg()
+
+import sys
+from mysite.wsgi import application
+
+# the most requests served at once
+MAX_CONNECTIONS = 1000
+
+
+def serve(port=8000, max_connections=MAX_CONNECTIONS):
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer(('', port), application, spawn=max_connections)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
@@ -17,6 +17,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ROOT_DIR + '/database/mysite.db',
+        # a file rather than memory so tests can vote from several threads
+        'TEST_NAME': ROOT_DIR + '/database/test_mysite.db',
         # The following settings are not used with sqlite3:
         'USER': '',
         'PASSWORD': '',
@@ -25,6 +27,32 @@ DATABASES = {
     }
 }
 
+# The page caches and their versions, rate limits, live results and the
+# vote buffer are only shared by the workers that share this cache. This
+# one lives in the memory of one process, which is enough for runserver
+# and gives the tests a cache of their own. settings_production.py uses
+# memcached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Reads of the polls models that aren't cached go to a random one of
+# these database aliases, which is little more than the archive (see
+# polls/routers.py). For example, with a copy of the database file:
+#   DATABASES['replica'] = dict(DATABASES['default'],
+#       NAME=ROOT_DIR + '/database/replica.db', TEST_MIRROR='default')
+#   POLLS_READ_REPLICAS = ('replica',)
+DATABASE_ROUTERS = ['polls.routers.ReplicaRouter']
+POLLS_READ_REPLICAS = ()
+# a client reads from default for this many seconds after it voted
+POLLS_REPLICA_STICKY_SECONDS = 10
+
+# PRAGMAs run on every new SQLite connection, in order, as (name, value).
+# mysite/settings_production.py turns on WAL.
+POLLS_SQLITE_PRAGMAS = ()
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -99,15 +127,65 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'polls.middleware.RequestTimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'polls.middleware.VoteRateLimitMiddleware',
+    'polls.middleware.ReplicaPinMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Share of requests (0 to 1) that RequestTimingMiddleware logs with their
+# query count, SQL, render and total time and a Server-Timing header.
+POLLS_TIMING_SAMPLE_RATE = 0.01
+
+# Token bucket limits for VoteRateLimitMiddleware, (tokens, seconds):
+# a bucket holds that many requests and refills over that many seconds.
+# The buckets live in POLLS_RATE_LIMIT_CACHE, or in the process if it
+# can't be reached. polls:detail is the only view that takes votes.
+POLLS_RATE_LIMIT_VIEWS = ('polls:detail',)
+POLLS_RATE_LIMIT_CLIENT = (10, 60)
+POLLS_RATE_LIMIT_POLL = (1000, 1)
+POLLS_RATE_LIMIT_CACHE = 'default'
+
+# Count votes in the cache and add them to the database in batches
+# (see polls/buffer.py). Results can be POLLS_VOTE_BUFFER_INTERVAL seconds
+# old, run "manage.py flush_votes" to write them right away. Needs
+# memcached, or the LocMemCache when the site runs in one process and
+# POLLS_VOTE_BUFFER_SINGLE_PROCESS is on.
+POLLS_VOTE_BUFFER = False
+POLLS_VOTE_BUFFER_SINGLE_PROCESS = False
+POLLS_VOTE_BUFFER_SIZE = 500
+POLLS_VOTE_BUFFER_INTERVAL = 5
+
+# Only count one vote per voter per poll (polls/dedupe.py). Voters known
+# to have voted are kept in an LRU set of POLLS_DEDUPE_MAX_ENTRIES per
+# process and in the cache for POLLS_DEDUPE_CACHE_TIMEOUT seconds.
+POLLS_DEDUPE_VOTES = False
+POLLS_DEDUPE_MAX_ENTRIES = 100000
+POLLS_DEDUPE_CACHE_TIMEOUT = 86400
+
+# Live results (polls/live.py). CacheBroker works across processes,
+# polls.live.MemoryBroker only within one process.
+POLLS_LIVE_BROKER = 'polls.live.CacheBroker'
+# the most updates a second each stream sends
+POLLS_LIVE_MAX_RATE = 2
+POLLS_LIVE_HEARTBEAT = 15
+POLLS_LIVE_TIMEOUT = 300
+# the longest polls:results_json holds a ?wait= request
+POLLS_LONG_POLL_TIMEOUT = 30
+
+# Seconds the poll and results pages are cached for. Votes and edits
+# replace them sooner. Keep it under django_comments' two hour limit on
+# the age of the comment form on the results page.
+POLLS_PAGE_CACHE_TIMEOUT = 3600
+# log the page cache hit rate every this many requests per process
+POLLS_PAGE_CACHE_LOG_EVERY = 1000
+
 ROOT_URLCONF = 'mysite.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
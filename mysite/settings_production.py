@@ -0,0 +1,46 @@
+"""
+Production settings for a single server on SQLite
+
+    DJANGO_SETTINGS_MODULE=mysite.settings_production gunicorn mysite.wsgi
+
+python -m benchmarks.sqlite compares concurrent votes and reads with and
+without this profile.
+
+The workers share a memcached at $MEMCACHED (127.0.0.1:11211 by
+default), which needs python-memcached. It is not in requirements.txt
+since the development settings don't use it.
+"""
+import os
+from mysite.settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = DEBUG
+
+ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', 'localhost').split(',')
+
+# one cache for every worker, its incr() and add() are atomic
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get('MEMCACHED', '127.0.0.1:11211'),
+    }
+}
+
+DATABASES = {
+    'default': dict(DATABASES['default'],
+        # keep connections between requests instead of opening one for each
+        CONN_MAX_AGE=600,
+        # seconds a query waits for another connection's write lock
+        OPTIONS={'timeout': 5}),
+}
+
+# WAL lets readers go on while a vote is written, NORMAL only syncs
+# at checkpoints (safe in WAL mode, a power cut can lose the last
+# commits but not corrupt the file) and reads are served from a
+# memory map of the first 256MB.
+POLLS_SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 268435456),
+    ('busy_timeout', 5000),
+)
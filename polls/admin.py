@@ -8,14 +8,16 @@ class ChoiceInline(admin.TabularInline):
 
 
 class PollAdmin(admin.ModelAdmin):
-    list_display = ('question', 'pub_date', 'was_published_recently')
-    list_filter = ['pub_date']
+    list_display = ('question', 'pub_date', 'state', 'was_published_recently')
+    list_filter = ['state', 'pub_date']
     search_fields = ['question']
     date_hierarchy = 'pub_date'
 
     fieldsets = [
         (None, {'fields': ['question', 'max_answers']}),
-        ('Date information', {'fields': ['pub_date'], 'classes': ['collapse']}),
+        ('Performance', {'fields': ['vote_shards'], 'classes': ['collapse']}),
+        ('Date information', {'fields': ['pub_date', 'close_date', 'state'],
+            'classes': ['collapse']}),
     ]
     inlines = [ChoiceInline]
 
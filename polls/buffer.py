@@ -0,0 +1,198 @@
+"""
+Write-behind vote buffer
+
+When ``POLLS_VOTE_BUFFER`` is on, votes posted to ``DetailView`` are
+appended to the cache instead of updating ``Choice.votes`` right away.
+``flush()`` adds the buffered votes to the choices in batched UPDATEs
+when ``POLLS_VOTE_BUFFER_SIZE`` votes are waiting, when the last flush is
+older than ``POLLS_VOTE_BUFFER_INTERVAL`` seconds, or when
+``manage.py flush_votes`` is run.
+
+Every flush first claims a range of buffered votes and records it as a
+``FlushedVoteBatch`` in the same transaction as the UPDATEs. A flush that
+dies part way is retried with the same range, and a range that was already
+committed is skipped, so every vote is counted exactly once.
+
+This relies on the cache's ``incr()`` and ``add()`` being atomic for
+every process, so the buffer only runs in memcached, or in a LocMemCache
+when ``POLLS_VOTE_BUFFER_SINGLE_PROCESS`` says the site is one process.
+
+A vote takes its number before it is stored, so a flush only claims up
+to the first vote that isn't stored yet. One that is still missing after
+``LOCK_TIMEOUT`` seconds was lost (its process died or the cache evicted
+it) and is skipped.
+"""
+import time
+import datetime
+import logging
+logger = logging.getLogger('mysite.log')
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import (MemcachedCache,
+    PyLibMCCache)
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from polls.caching import TIMEOUT
+from polls.models import Choice, FlushedVoteBatch, Vote
+
+KEY_PREFIX = 'polls:votebuffer:'
+SEQ_KEY = KEY_PREFIX + 'seq'
+FLUSHED_KEY = KEY_PREFIX + 'flushed'
+CLAIMED_KEY = KEY_PREFIX + 'claimed'
+LOCK_KEY = KEY_PREFIX + 'lock'
+LAST_FLUSH_KEY = KEY_PREFIX + 'last_flush'
+MISSING_KEY = KEY_PREFIX + 'missing'
+# a flush that takes longer than this is assumed to have crashed
+LOCK_TIMEOUT = 60
+
+
+def check_cache():
+    """
+    Raises ImproperlyConfigured unless every process sees the same cache
+    and its incr() and add() are atomic. Other backends hand the same
+    number to two votes and let two flushes claim the same votes.
+    """
+    if isinstance(cache, (MemcachedCache, PyLibMCCache)):
+        return
+    if isinstance(cache, LocMemCache) and getattr(settings,
+            'POLLS_VOTE_BUFFER_SINGLE_PROCESS', False):
+        return
+    raise ImproperlyConfigured("The vote buffer needs memcached, or a "
+        "LocMemCache with POLLS_VOTE_BUFFER_SINGLE_PROCESS on, not %s" %
+        cache.__class__.__name__)
+
+
+def enabled():
+    if not getattr(settings, 'POLLS_VOTE_BUFFER', False):
+        return False
+    check_cache()
+    return True
+
+
+def _vote_key(seq):
+    return '%svote:%s' % (KEY_PREFIX, seq)
+
+
+def _next_seq():
+    try:
+        return cache.incr(SEQ_KEY)
+    except ValueError:
+        # carry on after the flushed votes if the sequence was evicted
+        cache.add(SEQ_KEY, cache.get(FLUSHED_KEY, 0) or 0, TIMEOUT)
+        return cache.incr(SEQ_KEY)
+
+
+def _lost(seq):
+    """
+    Whether vote ``seq`` has been missing for ``LOCK_TIMEOUT`` seconds
+    """
+    missing = cache.get(MISSING_KEY)
+    if missing is None or missing[0] != seq:
+        cache.set(MISSING_KEY, (seq, time.time()), TIMEOUT)
+        return False
+    return time.time() - missing[1] >= LOCK_TIMEOUT
+
+
+def pending():
+    """
+    The number of buffered votes that have not been flushed
+    """
+    return (cache.get(SEQ_KEY, 0) or 0) - (cache.get(FLUSHED_KEY, 0) or 0)
+
+
+def append(choices, fingerprint=''):
+    """
+    Buffers one vote for ``choices`` and flushes the buffer
+    if it is full or has not been flushed for a while.
+    """
+    cache.add(LAST_FLUSH_KEY, time.time(), TIMEOUT)
+    vote = (choices[0].poll_id, [c.pk for c in choices], fingerprint,
+        timezone.now())
+    seq = _next_seq()
+    cache.set(_vote_key(seq), vote, TIMEOUT)
+
+    size = getattr(settings, 'POLLS_VOTE_BUFFER_SIZE', 500)
+    interval = getattr(settings, 'POLLS_VOTE_BUFFER_INTERVAL', 5)
+    last_flush = cache.get(LAST_FLUSH_KEY) or 0
+    if pending() >= size or time.time() - last_flush >= interval:
+        flush()
+    return seq
+
+
+def _claim():
+    claimed = cache.get(CLAIMED_KEY)
+    if claimed is not None:
+        return claimed
+    start = (cache.get(FLUSHED_KEY, 0) or 0) + 1
+    end = cache.get(SEQ_KEY, 0) or 0
+    stored = cache.get_many([_vote_key(seq) for seq in range(start, end + 1)])
+    for seq in range(start, end + 1):
+        if _vote_key(seq) in stored:
+            continue
+        if not _lost(seq):
+            end = seq - 1
+            break
+        logger.warning("buffered vote %s was lost" % seq)
+    if end < start:
+        return None
+    claimed = (start, end)
+    cache.set(CLAIMED_KEY, claimed, TIMEOUT)
+    return claimed
+
+
+def _apply(counts):
+    # one UPDATE for all the choices that got the same number of votes
+    by_count = {}
+    for choice_id, votes in counts.items():
+        by_count.setdefault(votes, []).append(choice_id)
+    for votes, ids in by_count.items():
+        Choice.objects.filter(pk__in=ids).update(votes=F('votes') + votes)
+
+
+def flush():
+    """
+    Adds the votes buffered so far to ``Choice.votes``.
+    Returns the number of choice votes flushed, or ``None`` if another
+    process is already flushing.
+    """
+    if not cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+        return None
+    flushed = 0
+    try:
+        claimed = _claim()
+        if claimed is not None:
+            start, end = claimed
+            keys = [_vote_key(seq) for seq in range(start, end + 1)]
+            counts = {}
+            poll_ids = set()
+            log = []
+            for poll_id, choice_ids, fingerprint, timestamp in (
+                    cache.get_many(keys).values()):
+                poll_ids.add(poll_id)
+                for choice_id in choice_ids:
+                    counts[choice_id] = counts.get(choice_id, 0) + 1
+                    log.append(Vote(poll_id=poll_id, choice_id=choice_id,
+                        fingerprint=fingerprint, timestamp=timestamp))
+            try:
+                with transaction.atomic():
+                    FlushedVoteBatch.objects.create(key='%s-%s' % claimed)
+                    _apply(counts)
+                    Vote.objects.bulk_create(log)
+                    # only the latest batch can be retried
+                    FlushedVoteBatch.objects.filter(flushed_at__lt=
+                        timezone.now() - datetime.timedelta(days=1)).delete()
+            except IntegrityError:
+                logger.info("vote batch %s-%s was already flushed" % claimed)
+            else:
+                flushed += sum(counts.values())
+                Choice.objects.votes_changed(poll_ids)
+            cache.set(FLUSHED_KEY, end, TIMEOUT)
+            cache.delete(CLAIMED_KEY)
+            cache.delete_many(keys)
+        cache.set(LAST_FLUSH_KEY, time.time(), TIMEOUT)
+    finally:
+        cache.delete(LOCK_KEY)
+    return flushed
@@ -0,0 +1,156 @@
+"""
+Versioned caches for poll pages
+
+Each cache has a ``name`` and a version number. ``invalidate(name)`` bumps
+the version so every entry stored under the old version is ignored,
+including template fragments that use ``version(name)`` in their key.
+Hits, misses and invalidations are counted per name, see ``stats()``.
+
+Versions start from the current time in milliseconds rather than 1, so a
+version that was evicted from the cache doesn't start again at a number
+that was already handed out (for example in an ETag).
+"""
+import time
+import logging
+logger = logging.getLogger('mysite.log')
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from polls import routers
+
+KEY_PREFIX = 'polls:cache:'
+COUNTERS = ('hits', 'misses', 'invalidations')
+# How long versions and counters are kept. Not None: Django's add() takes
+# a key stored without an expiry for a missing one and replaces it. At
+# most 30 days, memcached reads longer timeouts as a point in time.
+TIMEOUT = 30 * 24 * 60 * 60
+
+
+def _key(name, part):
+    return '%s%s:%s' % (KEY_PREFIX, name, part)
+
+
+def _incr(key, initial=0):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # missing, start it unless another process just did
+        cache.add(key, initial, TIMEOUT)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # evicted between add() and incr()
+        cache.set(key, initial + 1, TIMEOUT)
+        return initial + 1
+
+
+def poll(pk):
+    """
+    The name for what is cached about poll ``pk``.
+    Its version changes whenever the poll, its choices or its counted
+    votes change.
+    """
+    return 'poll:%s' % pk
+
+
+def choices(pk):
+    """
+    The name for the choices of poll ``pk``, see ``polls.forms``.
+    Unlike ``poll()`` votes don't change its version.
+    """
+    return 'choices:%s' % pk
+
+
+def comments(pk):
+    """
+    The name for the comments on poll ``pk``, see ``polls.comments``
+    """
+    return 'comments:%s' % pk
+
+
+def _first_version():
+    return int(time.time() * 1000)
+
+
+def version(name, create=True):
+    """
+    The current version of ``name``. A missing version is started,
+    unless ``create`` is false, then it is ``None``.
+    """
+    current = cache.get(_key(name, 'version'))
+    if current is None and create:
+        cache.add(_key(name, 'version'), _first_version(), TIMEOUT)
+        current = cache.get(_key(name, 'version')) or _first_version()
+    return current
+
+
+def invalidate(name):
+    """
+    Drops everything cached for ``name``. Returns the new version.
+    """
+    _incr(_key(name, 'invalidations'))
+    return _incr(_key(name, 'version'), _first_version())
+
+
+def get(name, build):
+    """
+    Returns the value cached for ``name``, calling ``build()`` on a miss.
+
+    ``build`` returns ``(value, expires)`` and reads from the primary
+    database. ``expires`` is the datetime
+    the value goes stale, or ``None`` if only ``invalidate()`` makes it
+    stale. Reaching ``expires`` invalidates the whole cache so fragments
+    keyed on ``version(name)`` are rebuilt too.
+    """
+    current = version(name)
+    entry = cache.get(_key(name, 'value'))
+    if entry is not None and entry[0] == current:
+        expires = entry[2]
+        if expires is None or timezone.now() < expires:
+            _incr(_key(name, 'hits'))
+            return entry[1]
+        current = invalidate(name)
+    _incr(_key(name, 'misses'))
+    # a replica can be behind the version, what it returned would be
+    # cached as that version
+    with routers.primary():
+        value, expires = build()
+    cache.set(_key(name, 'value'), (current, value, expires), TIMEOUT)
+    return value
+
+
+def stats(name):
+    """
+    The hit, miss and invalidation counts for ``name``
+    """
+    counts = cache.get_many([_key(name, counter) for counter in COUNTERS])
+    return dict((counter, counts.get(_key(name, counter), 0))
+        for counter in COUNTERS)
+
+
+def page_key(view, pk, versions, language):
+    """
+    The key of a rendered page of poll ``pk``, see ``polls.views``
+    """
+    return '%spage:%s:%s:%s:%s' % (KEY_PREFIX, view, pk,
+        ':'.join(str(v) for v in versions), language)
+
+
+# page cache lookups in this process since the hit rate was last logged,
+# name: (hits, lookups)
+_page_lookups = {}
+
+
+def count_page(name, hit):
+    """
+    Counts a page cache hit or miss in ``stats(name)`` and logs the hit
+    rate of every ``POLLS_PAGE_CACHE_LOG_EVERY`` lookups in this process
+    """
+    _incr(_key(name, 'hits' if hit else 'misses'))
+    hits, lookups = _page_lookups.get(name, (0, 0))
+    hits, lookups = hits + bool(hit), lookups + 1
+    if lookups >= getattr(settings, 'POLLS_PAGE_CACHE_LOG_EVERY', 1000):
+        logger.info("%s cache: %.1f%% hits over %s requests" % (
+            name, 100.0 * hits / lookups, lookups))
+        hits, lookups = 0, 0
+    _page_lookups[name] = (hits, lookups)
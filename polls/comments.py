@@ -0,0 +1,49 @@
+"""
+Cached comments for the results page
+
+The comment count and the rendered pages of comments are cached under
+``caching.comments(poll_id)``, which changes whenever a comment on the
+poll is saved or deleted (see ``polls.models``). That covers posting,
+flagging, approving and deleting since django_comments saves the
+comment before sending its signals.
+
+The results page shows the newest ``POLLS_COMMENTS_PER_PAGE`` comments
+and loads older pages from the ``polls:comments`` view when asked.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.paginator import Paginator, Page, EmptyPage
+from django.utils.encoding import force_text
+from django.utils.functional import SimpleLazyObject
+import django_comments
+from polls import caching
+
+
+def visible(poll):
+    """
+    The poll's public comments, newest first
+    """
+    return django_comments.get_model().objects.filter(
+        content_type=ContentType.objects.get_for_model(poll),
+        object_pk=force_text(poll.pk), site__pk=settings.SITE_ID,
+        is_public=True, is_removed=False).order_by('-submit_date', '-pk')
+
+
+def count(poll):
+    return caching.get(caching.comments(poll.pk),
+        lambda: (visible(poll).count(), None))
+
+
+def page(poll, number=1):
+    """
+    Page ``number`` of the poll's comments. Nothing is queried until the
+    page is used, so a cached fragment costs no queries.
+    """
+    def build():
+        paginator = Paginator(visible(poll),
+            getattr(settings, 'POLLS_COMMENTS_PER_PAGE', 20))
+        try:
+            return paginator.page(number)
+        except EmptyPage:
+            return Page([], number, paginator)
+    return SimpleLazyObject(build)
@@ -0,0 +1,114 @@
+"""
+One vote per voter per poll
+
+With ``POLLS_DEDUPE_VOTES`` on, a voter's fingerprint (see
+``polls.voters``) is claimed with a ``Ballot`` row whose unique index on
+(poll, fingerprint) is the final word. Voters that are known to have
+voted are remembered in a per-process LRU set of at most
+``POLLS_DEDUPE_MAX_ENTRIES`` entries and in the cache, so repeat votes
+are usually turned away without touching the database. A first vote
+costs one INSERT in the vote's transaction and no extra SELECT.
+"""
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from polls.models import Ballot
+
+KEY_PREFIX = 'polls:voted:'
+
+
+class LRUSet(object):
+    """
+    A set that forgets the least recently used entries
+    past ``max_entries``
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            # move it to the recently used end
+            del self._entries[key]
+            self._entries[key] = True
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = True
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_seen = None
+
+
+def enabled():
+    return getattr(settings, 'POLLS_DEDUPE_VOTES', False)
+
+
+def seen():
+    global _seen
+    if _seen is None:
+        _seen = LRUSet(getattr(settings, 'POLLS_DEDUPE_MAX_ENTRIES', 100000))
+    return _seen
+
+
+def reset():
+    """
+    Forgets the voters remembered by this process
+    """
+    global _seen
+    _seen = None
+
+
+def _key(poll_id, fingerprint):
+    return '%s:%s' % (poll_id, fingerprint)
+
+
+def remember(poll_id, fingerprint):
+    key = _key(poll_id, fingerprint)
+    seen().add(key)
+    cache.set(KEY_PREFIX + key, True,
+        getattr(settings, 'POLLS_DEDUPE_CACHE_TIMEOUT', 86400))
+
+
+def already_voted(poll_id, fingerprint):
+    """
+    True if the voter is known to have voted. False means the database
+    has the final say, see ``claim()``.
+    """
+    key = _key(poll_id, fingerprint)
+    if key in seen():
+        return True
+    if cache.get(KEY_PREFIX + key):
+        seen().add(key)
+        return True
+    return False
+
+
+def claim(poll, fingerprint):
+    """
+    Records the voter's ballot for ``poll``.
+    Returns False if they have already voted.
+    Call ``remember()`` once the vote is committed.
+    """
+    if already_voted(poll.pk, fingerprint):
+        return False
+    try:
+        with transaction.atomic():
+            Ballot.objects.create(poll=poll, fingerprint=fingerprint)
+    except IntegrityError:
+        remember(poll.pk, fingerprint)
+        return False
+    return True
@@ -1,8 +1,83 @@
 import logging
 logger = logging.getLogger('mysite.log')
 from django import forms
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 from polls.models import Choice
+from polls import buffer as vote_buffer
+from polls import caching
+
+
+def validate_answer_count(poll, count):
+    """
+    Raises a ValidationError if ``count`` choices is too many for
+    ``poll``. Shared by PollForm and the vote importer in polls.ingest.
+    """
+    if count > poll.max_answers:
+        raise forms.ValidationError(
+             _("Too many options selected. Max is %s" % poll.max_answers))
+
+
+# poll id -> (choices version, choice list) for this process
+_choice_lists = {}
+
+
+def choice_list(poll):
+    """
+    ``[(id, choice_text), ...]`` of the poll's choices. Kept in this
+    process and in the cache until a choice of the poll is changed.
+    """
+    name = caching.choices(poll.pk)
+    version = caching.version(name)
+    cached = _choice_lists.get(poll.pk)
+    if cached is None or cached[0] != version:
+        choices = caching.get(name, lambda: (list(
+            Choice.objects.filter(poll=poll.pk).order_by('pk').values_list(
+                'id', 'choice_text')), None))
+        cached = (version, choices)
+        _choice_lists[poll.pk] = cached
+    return cached[1]
+
+
+class CachedChoicesMixin(object):
+    """
+    Checks submitted ids against a set of the poll's choice ids
+    instead of querying for them
+    """
+
+    def __init__(self, poll, choices, *args, **kwargs):
+        self.poll_id = poll.pk
+        self.choice_texts = dict(choices)
+        kwargs['choices'] = choices
+        kwargs['coerce'] = int
+        super(CachedChoicesMixin, self).__init__(*args, **kwargs)
+
+    def valid_value(self, value):
+        try:
+            return int(value) in self.choice_texts
+        except (TypeError, ValueError):
+            return False
+
+    def to_choice(self, pk):
+        # validate() skips falsy values such as an id of 0
+        if pk not in self.choice_texts:
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice', params={'value': pk})
+        return Choice(pk=pk, poll_id=self.poll_id,
+            choice_text=self.choice_texts[pk])
+
+
+class PollChoiceField(CachedChoicesMixin, forms.TypedChoiceField):
+    def clean(self, value):
+        return self.to_choice(super(PollChoiceField, self).clean(value))
+
+
+class PollMultipleChoiceField(CachedChoicesMixin,
+        forms.TypedMultipleChoiceField):
+    def clean(self, value):
+        pks = super(PollMultipleChoiceField, self).clean(value)
+        return [self.to_choice(pk) for pk in sorted(set(pks))]
 
 
 class PollForm(forms.Form):
@@ -21,52 +96,70 @@ class PollForm(forms.Form):
         # change the 'widget' based on max_answers of the poll
         #TODO: not allowed to be zero or negetive
         #TODO: where to check for that
+        # the choices come from choice_list() so building and validating
+        # the form doesn't query the database
+        choices = choice_list(self.instance)
         if self.instance.max_answers == 1:
             #empty_labelis for None or Other field if you want
-            self.fields['choice'] = forms.ModelChoiceField(
-                queryset=Choice.objects.filter(poll=self.instance.pk),
-                empty_label=None,
+            self.fields['choice'] = PollChoiceField(
+                self.instance, choices,
                 widget=forms.RadioSelect)
             #TODO: would be nice to do this
             #self.fields['choice'] = forms.ModelMultipleChoiceField(
                 #queryset=Choice.objects.filter(poll=self.instance.pk),
                 #widget=forms.RadioSelect)
         else:
-            self.fields['choice'] = forms.ModelMultipleChoiceField(
-                queryset=Choice.objects.filter(poll=self.instance.pk),
+            self.fields['choice'] = PollMultipleChoiceField(
+                self.instance, choices,
                 widget=forms.CheckboxSelectMultiple())
 
     def clean_choice(self):
         choices = self.cleaned_data['choice']
-        logger.info(type(choices))
-        logger.info(type(choices) != Choice)
-        #if choices is a QuerySet
+        #if choices is a list
         if type(choices) != Choice:
-            if choices.count() > self.instance.max_answers:
             #TODO: for 1.6 best practices
             #raise forms.ValidationError(
             #    _("Too many options selected. Max is %(value)s"),
             #    code='invalid',
             #    params={'value': choices.count()},
             #)
-                raise forms.ValidationError(
-                     _("Too many options selected. Max is %s" %
-                         self.instance.max_answers))
+            validate_answer_count(self.instance, len(choices))
         return choices
 
-    def save(self):
+    def save(self, fingerprint=''):
         if not self.is_valid():
             raise forms.ValidationError(
                 _("PollForm was not validated before calling 'save()'."))
 
+        choices = self.selected_choices()
+        # one UPDATE for every selected choice
+        with transaction.atomic():
+            Choice.objects.record_votes(
+                choices, self.instance.vote_shards, fingerprint)
+        return choices[-1]
+
+    def buffer(self, fingerprint=''):
+        """
+        Like ``save()`` but the vote is added to the write-behind
+        buffer in ``polls.buffer`` instead of the database.
+        """
+        if not self.is_valid():
+            raise forms.ValidationError(
+                _("PollForm was not validated before calling 'buffer()'."))
+
+        choices = self.selected_choices()
+        vote_buffer.append(choices, fingerprint)
+        return choices[-1]
+
+    def selected_choices(self):
+        """
+        A list of the choices that were voted for
+        """
         choices = self.cleaned_data['choice']
-        # If is not a QuerySet of Choices make it a list to iterate through it
+        # If is not a list of Choices make it a list to iterate through it
         if type(choices) == Choice:
-            choices = [choices]
-
-        for choice in choices:
-            choice.record_vote()
-        return choice
+            return [choices]
+        return list(choices)
 
 '''
 def vote_form_class(poll):
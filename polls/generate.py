@@ -0,0 +1,171 @@
+"""
+Synthetic polls for scale testing
+
+``generate()`` adds polls shaped like production data. Most polls were
+published in the last few weeks, a few are scheduled for the future and
+a few have fewer than two choices so they are never published. Votes
+follow a long tail: most polls have a handful and a few have most of
+them.
+
+The rows are built as tuples and written with one ``executemany()`` per
+table and chunk, with their ids set up front so choices don't have to
+read back their poll ids. ``bulk_create`` spent most of its time making
+model instances and SQL for batches of a few hundred rows. No signals
+are sent, ``choice_count`` is filled in directly. The votes aren't in the
+``Vote`` log, so they are archived votes too.
+
+On SQLite ``PRAGMA synchronous`` is off and the page cache is 256 MB
+while generating, unless it runs inside a transaction, which can't turn
+synchronous off. A crash can then leave the database corrupt, so
+generate into a database you can throw away.
+"""
+import datetime
+import random
+from contextlib import contextmanager
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from polls import caching
+from polls.models import Poll, Choice
+
+
+# the columns each row tuple holds values for
+POLL_FIELDS = ('id', 'question', 'pub_date', 'state', 'max_answers',
+    'vote_shards', 'choice_count')
+CHOICE_FIELDS = ('id', 'poll', 'choice_text', 'votes', 'archived_votes')
+
+
+def next_id(model):
+    return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+
+def insert(model, fields, rows):
+    """
+    Adds ``rows``, tuples of the values of ``fields`` ready for the
+    database, with one ``executemany()``
+    """
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(name).column) for name in fields]
+    connection.cursor().executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table), ', '.join(columns),
+        ', '.join(['%s'] * len(columns))), rows)
+
+
+class PollGenerator(object):
+    def __init__(self, seed=0, future=0.05, sparse=0.02, min_choices=2,
+            max_choices=6, days=365):
+        self.random = random.Random(seed)
+        # shares of scheduled polls and of polls with under 2 choices
+        self.future = future
+        self.sparse = sparse
+        self.min_choices = min_choices
+        self.max_choices = max_choices
+        self.days = days
+        self.now = timezone.now()
+
+    def pub_date(self):
+        if self.random.random() < self.future:
+            minutes = self.random.randint(1, 90 * 24 * 60)
+        else:
+            # newer polls are more common
+            minutes = -min(int(self.random.expovariate(1.0 / (30 * 24 * 60))),
+                self.days * 24 * 60)
+        return self.now + datetime.timedelta(minutes=minutes)
+
+    def choice_count(self):
+        if self.random.random() < self.sparse:
+            return self.random.randint(0, 1)
+        return self.random.randint(self.min_choices, self.max_choices)
+
+    def votes(self, count):
+        """
+        Vote counts for ``count`` choices, a few popular polls and a
+        favourite choice in each
+        """
+        total = int(self.random.paretovariate(1.2) * 10) - 10
+        weights = [self.random.paretovariate(1.5) for i in range(count)]
+        scale = float(total) / (sum(weights) or 1)
+        return [int(weight * scale) for weight in weights]
+
+    def chunk(self, first_poll_id, first_choice_id, size):
+        """
+        ``(polls, choices)``, the rows of ``size`` polls and of their
+        choices as tuples of ``POLL_FIELDS`` and ``CHOICE_FIELDS``
+        """
+        to_db = connection.ops.value_to_db_datetime
+        polls = []
+        choices = []
+        for poll_id in range(first_poll_id, first_poll_id + size):
+            count = self.choice_count()
+            pub_date = self.pub_date()
+            polls.append((poll_id, "Generated poll %s" % poll_id,
+                to_db(pub_date),
+                Poll.LIVE if pub_date <= self.now else Poll.SCHEDULED,
+                1 if self.random.random() < 0.8 else max(count, 1),
+                # one vote shard, the default
+                1, count))
+            for i, votes in enumerate(self.votes(count)):
+                choices.append((first_choice_id + len(choices), poll_id,
+                    "Choice %s" % (i + 1), votes, votes))
+        return polls, choices
+
+
+# SQLite settings while generating, (name, value)
+FAST_PRAGMAS = (
+    ('synchronous', 'OFF'),
+    # KiB, the indexes of a million polls stay in memory
+    ('cache_size', -256 * 1024),
+)
+
+
+@contextmanager
+def fast_writes():
+    """
+    Runs the ``FAST_PRAGMAS`` on SQLite inside the block, when it isn't
+    in a transaction
+    """
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        yield
+        return
+    cursor = connection.cursor()
+    saved = []
+    for name, value in FAST_PRAGMAS:
+        cursor.execute('PRAGMA %s' % name)
+        saved.append((name, cursor.fetchone()[0]))
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    try:
+        yield
+    finally:
+        for name, value in saved:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def generate(count, chunk_size=50000, **kwargs):
+    """
+    Adds ``count`` polls and their choices, one transaction per
+    ``chunk_size`` polls. Returns the number of choices added.
+    """
+    generator = PollGenerator(**kwargs)
+    poll_id = next_id(Poll)
+    choice_id = next_id(Choice)
+    added = 0
+    with fast_writes():
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            polls, choices = generator.chunk(poll_id, choice_id, size)
+            with transaction.atomic():
+                insert(Poll, POLL_FIELDS, polls)
+                insert(Choice, CHOICE_FIELDS, choices)
+            poll_id += size
+            choice_id += len(choices)
+            added += len(choices)
+    # the ids were set by hand, move the sequences past them
+    sql = connection.ops.sequence_reset_sql(no_style(), [Poll, Choice])
+    if sql:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for statement in sql:
+                cursor.execute(statement)
+    caching.invalidate('index')
+    return added
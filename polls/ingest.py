@@ -0,0 +1,178 @@
+"""
+Bulk vote import
+
+Reads ballots as newline delimited JSON::
+
+    {"poll": 1, "choices": [3, 4]}
+    {"poll": 1, "choice": 3}
+
+or CSV with the poll id followed by the choice ids::
+
+    poll,choice
+    1,3,4
+
+Every ballot is checked like ``PollForm`` checks a vote: the poll has to
+be published, every choice has to belong to it and there can't be more
+choices than ``max_answers``. Valid ballots are counted in memory and
+added to ``Choice.votes`` in chunked UPDATEs, one transaction per chunk,
+and to the ``Vote`` log with the importer's ``source`` as the fingerprint.
+"""
+import csv
+import json
+from django import forms
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from polls.forms import validate_answer_count
+from polls.models import Poll, Choice, Vote
+
+# the most errors kept for the report
+MAX_ERRORS = 100
+
+
+class InvalidBallot(Exception):
+    pass
+
+
+class VoteImporter(object):
+    """
+    Counts ballots with ``add()`` and writes them with ``flush()``.
+    ``flush()`` is also called every ``chunk_size`` accepted ballots.
+    """
+
+    def __init__(self, chunk_size=10000, source='import'):
+        self.chunk_size = chunk_size
+        # the fingerprint of the imported votes in the Vote log
+        self.source = source
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+        self._polls = {}
+        self._counts = {}
+        self._poll_ids = set()
+        self._log = []
+        self._pending = 0
+        self.timestamp = timezone.now()
+
+    def _poll(self, poll_id):
+        # (poll, its choice ids), or None if it isn't published
+        if poll_id not in self._polls:
+            poll = Poll.objects.published().filter(pk=poll_id).first()
+            if poll is not None:
+                poll = (poll, set(poll.choices.values_list('id', flat=True)))
+            self._polls[poll_id] = poll
+        return self._polls[poll_id]
+
+    def check(self, poll_id, choice_ids):
+        """
+        Returns the poll and the set of choice ids of a valid ballot,
+        raises InvalidBallot otherwise
+        """
+        try:
+            poll_id = int(poll_id)
+            choice_ids = set(int(choice_id) for choice_id in choice_ids)
+        except (TypeError, ValueError):
+            raise InvalidBallot("Poll and choices must be ids")
+        found = self._poll(poll_id)
+        if found is None:
+            raise InvalidBallot("Poll %s is not published" % poll_id)
+        poll, valid_ids = found
+        if not choice_ids:
+            raise InvalidBallot("No choices")
+        if not choice_ids <= valid_ids:
+            raise InvalidBallot("Choices %s are not in poll %s" % (
+                sorted(choice_ids - valid_ids), poll_id))
+        try:
+            validate_answer_count(poll, len(choice_ids))
+        except forms.ValidationError as e:
+            raise InvalidBallot(' '.join(e.messages))
+        return poll, choice_ids
+
+    def add(self, poll_id, choice_ids, line=None):
+        try:
+            poll, choice_ids = self.check(poll_id, choice_ids)
+        except InvalidBallot as e:
+            self.reject(line, e)
+            return False
+        for choice_id in choice_ids:
+            self._counts[choice_id] = self._counts.get(choice_id, 0) + 1
+            self._log.append(Vote(poll_id=poll.pk, choice_id=choice_id,
+                timestamp=self.timestamp, fingerprint=self.source))
+        self._poll_ids.add(poll.pk)
+        self.accepted += 1
+        self._pending += 1
+        if self._pending >= self.chunk_size:
+            self.flush()
+        return True
+
+    def reject(self, line, error):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line, 'error': str(error)})
+
+    def flush(self):
+        """
+        Writes the counted votes with one UPDATE per vote count
+        (at most 500 choices each, under SQLite's variable limit)
+        """
+        if not self._counts:
+            return
+        by_count = {}
+        for choice_id, votes in self._counts.items():
+            by_count.setdefault(votes, []).append(choice_id)
+        with transaction.atomic():
+            for votes, ids in by_count.items():
+                for start in range(0, len(ids), 500):
+                    Choice.objects.filter(pk__in=ids[start:start + 500]
+                        ).update(votes=F('votes') + votes)
+            Vote.objects.bulk_create(self._log)
+        Choice.objects.votes_changed(self._poll_ids)
+        self._counts = {}
+        self._poll_ids = set()
+        self._log = []
+        self._pending = 0
+
+    def read_ndjson(self, lines):
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                ballot = json.loads(line)
+                choices = ballot.get('choices')
+                if choices is None:
+                    choices = [ballot['choice']]
+                poll = ballot['poll']
+                if not isinstance(choices, list):
+                    raise TypeError(choices)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.reject(number, "Not a ballot")
+                continue
+            self.add(poll, choices, number)
+
+    def read_csv(self, lines):
+        for number, row in enumerate(csv.reader(lines), 1):
+            if not row:
+                continue
+            if number == 1 and not row[0].strip().isdigit():
+                # header
+                continue
+            self.add(row[0], [c for c in row[1:] if c.strip()], number)
+
+    def run(self, lines, format='ndjson'):
+        """
+        Imports every ballot in ``lines`` and returns the report
+        """
+        if format == 'csv':
+            self.read_csv(lines)
+        else:
+            self.read_ndjson(lines)
+        self.flush()
+        return self.report()
+
+    def report(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
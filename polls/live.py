@@ -0,0 +1,134 @@
+"""
+Live results for the Server-Sent Events stream
+
+Votes call ``publish(poll_id)``. ``stream()`` waits on the broker named
+by ``POLLS_LIVE_BROKER`` and sends the results again whenever the poll's
+version in ``polls.caching`` has moved on, at most
+``POLLS_LIVE_MAX_RATE`` times a second so bursts of votes are coalesced
+into one update.
+
+The results payload is cached per poll version, so a thousand
+subscribers to one poll cost one results query per update.
+
+The waits only block on the broker. Run the stream under an event loop
+worker (for example ``gunicorn -k gevent``) so idle subscribers are
+cheap greenlets instead of threads.
+"""
+import json
+import threading
+import time
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+from polls import caching
+
+
+class MemoryBroker(object):
+    """
+    In process pub/sub, for tests and single process servers.
+    Every poll has an Event that is set and replaced on each publish.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def _event(self, poll_id):
+        with self._lock:
+            if poll_id not in self._events:
+                self._events[poll_id] = threading.Event()
+            return self._events[poll_id]
+
+    def publish(self, poll_id):
+        with self._lock:
+            event = self._events.pop(poll_id, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, poll_id, version, timeout):
+        """
+        Blocks until the poll's version is not ``version`` or ``timeout``
+        seconds pass. Returns the current version.
+        """
+        # take the event before reading the version so a publish
+        # in between isn't missed
+        event = self._event(poll_id)
+        current = caching.version(caching.poll(poll_id))
+        if current == version:
+            event.wait(timeout)
+            current = caching.version(caching.poll(poll_id))
+        return current
+
+
+class CacheBroker(object):
+    """
+    Shares updates between processes through the versions in the cache.
+    Publishing is free since votes already move the version on,
+    subscribers check it every ``interval`` seconds.
+    """
+    interval = 0.5
+
+    def publish(self, poll_id):
+        pass
+
+    def wait(self, poll_id, version, timeout):
+        end = time.time() + timeout
+        current = caching.version(caching.poll(poll_id))
+        while current == version and time.time() < end:
+            time.sleep(min(self.interval, max(end - time.time(), 0)))
+            current = caching.version(caching.poll(poll_id))
+        return current
+
+
+_brokers = {}
+
+
+def get_broker():
+    path = getattr(settings, 'POLLS_LIVE_BROKER', 'polls.live.CacheBroker')
+    if path not in _brokers:
+        _brokers[path] = import_by_path(path)()
+    return _brokers[path]
+
+
+def publish(poll_id):
+    get_broker().publish(poll_id)
+
+
+def results_payload(poll):
+    """
+    The poll's results as JSON, built once per poll version
+    """
+    def build():
+        choices, total_votes = poll.final_results()
+        return json.dumps({
+            'id': poll.id,
+            'total_votes': total_votes,
+            'choices': [dict((key, choice[key])
+                for key in ('id', 'votes', 'percent', 'rank'))
+                for choice in choices],
+        }), None
+    return caching.get(caching.poll(poll.id), build)
+
+
+def stream(poll, last_version=None):
+    """
+    Yields Server-Sent Events with the poll's results, sending a
+    comment every ``POLLS_LIVE_HEARTBEAT`` seconds while nothing changes.
+    Ends after ``POLLS_LIVE_TIMEOUT`` seconds, the browser reconnects
+    with ``Last-Event-ID`` set to the last version it got.
+    """
+    max_rate = getattr(settings, 'POLLS_LIVE_MAX_RATE', 2)
+    heartbeat = getattr(settings, 'POLLS_LIVE_HEARTBEAT', 15)
+    end = time.time() + getattr(settings, 'POLLS_LIVE_TIMEOUT', 300)
+    broker = get_broker()
+    yield 'retry: 1000\n\n'
+    while time.time() < end:
+        version = broker.wait(poll.id, last_version,
+            min(heartbeat, max(end - time.time(), 0)))
+        if version == last_version:
+            yield ': keepalive\n\n'
+            continue
+        last_version = version
+        yield 'id: %s\nevent: results\ndata: %s\n\n' % (
+            version, results_payload(poll))
+        # votes during the pause are sent together in the next update
+        time.sleep(1.0 / max_rate)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from polls import caching
+
+
+class Command(BaseCommand):
+    args = '[name ...]'
+    help = "Prints the hit, miss and invalidation counts of the poll caches"
+
+    def handle(self, *names, **options):
+        for name in names or ('index', 'page:detail', 'page:results'):
+            counts = caching.stats(name)
+            self.stdout.write("%s hits=%s misses=%s invalidations=%s" % (
+                name, counts['hits'], counts['misses'],
+                counts['invalidations']))
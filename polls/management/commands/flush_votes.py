@@ -0,0 +1,24 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from polls import buffer as vote_buffer
+
+
+class Command(BaseCommand):
+    help = "Adds the votes waiting in the vote buffer to Choice.votes"
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', dest='interval', default=None,
+            help='Keep running and flush every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        vote_buffer.check_cache()
+        while True:
+            flushed = vote_buffer.flush()
+            if flushed is None:
+                self.stdout.write("Another flush is running")
+            else:
+                self.stdout.write("Flushed %s votes" % flushed)
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
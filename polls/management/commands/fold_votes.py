@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from polls.models import Poll, ChoiceShard
+
+
+class Command(BaseCommand):
+    help = "Adds the votes counted in vote shards to Choice.votes"
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', type='int', dest='poll', default=None,
+            help='Only fold the shards of this poll id'),
+        make_option('--interval', type='float', dest='interval', default=None,
+            help='Keep running and fold every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        poll = None
+        if options['poll'] is not None:
+            try:
+                poll = Poll.objects.get(pk=options['poll'])
+            except Poll.DoesNotExist:
+                raise CommandError("Poll %s does not exist" % options['poll'])
+        while True:
+            folded = ChoiceShard.objects.fold(poll)
+            self.stdout.write("Folded %s votes" % folded)
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
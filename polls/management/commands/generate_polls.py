@@ -0,0 +1,37 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from polls.generate import generate
+
+
+class Command(BaseCommand):
+    help = ("Adds synthetic polls and choices for scale testing, "
+        "the same --seed always gives the same data")
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', dest='count', default=100000,
+            help='Polls to add'),
+        make_option('--seed', type='int', dest='seed', default=0),
+        make_option('--future', type='float', dest='future', default=0.05,
+            help='Share of polls published in the future'),
+        make_option('--sparse', type='float', dest='sparse', default=0.02,
+            help='Share of polls with fewer than 2 choices'),
+        make_option('--min-choices', type='int', dest='min_choices',
+            default=2),
+        make_option('--max-choices', type='int', dest='max_choices',
+            default=6),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=50000, help='Polls added per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if options['count'] < 0:
+            raise CommandError("--count can't be negative")
+        if not 0 <= options['min_choices'] <= options['max_choices']:
+            raise CommandError("--min-choices must be at most --max-choices")
+        start = time.time()
+        choices = generate(options['count'], options['chunk_size'],
+            seed=options['seed'], future=options['future'],
+            sparse=options['sparse'], min_choices=options['min_choices'],
+            max_choices=options['max_choices'])
+        self.stdout.write("Added %s polls and %s choices in %.1fs" % (
+            options['count'], choices, time.time() - start))
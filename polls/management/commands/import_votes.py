@@ -0,0 +1,44 @@
+import os
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from polls.ingest import VoteImporter
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Imports ballots from a newline delimited JSON or CSV file "
+        "(- for stdin)")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            choices=['ndjson', 'csv'],
+            help='ndjson or csv, guessed from the file name by default'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=10000, help='Ballots counted per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one file to import")
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = 'csv' if path.endswith('.csv') else 'ndjson'
+        if path == '-':
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(path, 'rb')
+            except IOError as e:
+                raise CommandError(e)
+        try:
+            source = ('import:%s' % os.path.basename(path))[:40]
+            report = VoteImporter(options['chunk_size'], source).run(
+                lines, format)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write("Imported %s ballots, rejected %s" % (
+            report['accepted'], report['rejected']))
+        for error in report['errors']:
+            self.stderr.write("line %s: %s" % (error['line'], error['error']))
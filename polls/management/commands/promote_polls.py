@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from polls import caching
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    help = ("Makes scheduled polls live once their pub_date has come "
+        "and closes live polls once their close_date has come. "
+        "Also sets the state of rows added before the column existed.")
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', dest='interval', default=None,
+            help='Keep running and check every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            promoted = Poll.objects.promote()
+            if promoted:
+                caching.invalidate('index')
+            closed = Poll.objects.close_due()
+            self.stdout.write("Promoted %s polls, closed %s" % (
+                promoted, closed))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
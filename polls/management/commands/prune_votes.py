@@ -0,0 +1,23 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from polls.models import Vote
+
+
+class Command(BaseCommand):
+    help = ("Deletes votes older than --days from the Vote log, "
+        "keeping their counts")
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+            help='Delete votes older than this many days'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=10000, help='Votes deleted per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None or options['days'] < 0:
+            raise CommandError("--days is required")
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        deleted = Vote.objects.prune(before, options['chunk_size'])
+        self.stdout.write("Deleted %s votes" % deleted)
@@ -0,0 +1,21 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from polls.models import Poll, Vote
+
+
+class Command(BaseCommand):
+    help = "Recounts Choice.votes from the Vote log"
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', type='int', dest='poll', default=None,
+            help='Only recount this poll id'),
+    )
+
+    def handle(self, *args, **options):
+        poll = None
+        if options['poll'] is not None:
+            try:
+                poll = Poll.objects.get(pk=options['poll'])
+            except Poll.DoesNotExist:
+                raise CommandError("Poll %s does not exist" % options['poll'])
+        recounted = Vote.objects.rebuild(poll)
+        self.stdout.write("Recounted %s choices" % recounted)
@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    help = ("Freezes the results of closed polls that have no snapshot "
+        "and closes live polls past their close_date")
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=500, help='Polls closed per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        ids = list(Poll.objects.filter(
+            Q(state=Poll.CLOSED, snapshot__isnull=True) |
+            Q(state=Poll.LIVE, close_date__lte=timezone.now())
+        ).values_list('id', flat=True))
+        closed = Poll.objects.close(ids, options['chunk_size'])
+        self.stdout.write("Froze the results of %s polls" % closed)
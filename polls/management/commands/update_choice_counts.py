@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    help = "Recounts Poll.choice_count, run it after adding the column"
+
+    def handle(self, *args, **options):
+        updated = Poll.objects.update_choice_counts()
+        self.stdout.write("Counted choices for %s polls" % updated)
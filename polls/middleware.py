@@ -0,0 +1,260 @@
+import json
+import math
+import random
+import threading
+import time
+import logging
+logger = logging.getLogger('mysite.log')
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connections
+from django.http import HttpResponse
+from polls import routers
+
+
+class TokenBuckets(object):
+    """
+    Token buckets kept in a Django cache, or in this process when the
+    cache can't be reached. A bucket holds up to ``capacity`` tokens and
+    gets all of them back over ``period`` seconds.
+
+    Reading and writing a bucket isn't atomic across processes, so under
+    heavy concurrency a few extra requests can get through. That is the
+    price of costing two cache round trips a request.
+    """
+
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+        self._cache = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.cache_alias)
+        return self._cache
+
+    def take(self, limits, now=None):
+        """
+        Takes a token from every bucket in ``limits``, a dict of
+        ``key: (capacity, period)``. Returns 0 if every bucket had one,
+        otherwise the seconds to wait before trying again.
+        """
+        now = time.time() if now is None else now
+        try:
+            states = self.cache.get_many(list(limits))
+        except Exception:
+            logger.exception("rate limit cache failed, using local buckets")
+            return self._take_local(limits, now)
+        wait, updates = self._take_all(limits, states, now)
+        try:
+            self.cache.set_many(updates,
+                int(max(period for capacity, period in limits.values())) + 1)
+        except Exception:
+            logger.exception("rate limit cache failed, using local buckets")
+        return wait
+
+    def _take_all(self, limits, states, now):
+        refilled = {}
+        wait = 0
+        for key, (capacity, period) in limits.items():
+            period = float(period)
+            tokens, updated = states.get(key) or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * capacity / period)
+            refilled[key] = tokens
+            if tokens < 1:
+                # seconds until there is a whole token again
+                wait = max(wait, (1 - tokens) * period / capacity)
+        # a refused request doesn't use up the other buckets
+        taken = 0 if wait else 1
+        return wait, dict((key, (tokens - taken, now))
+            for key, tokens in refilled.items())
+
+    def _take_local(self, limits, now):
+        with self._lock:
+            wait, updates = self._take_all(limits, self._local, now)
+            self._local.update(updates)
+        return wait
+
+
+class VoteRateLimitMiddleware(object):
+    """
+    Answers 429 Too Many Requests with a Retry-After header when a client,
+    or everyone together on one poll, posts to the views in
+    ``POLLS_RATE_LIMIT_VIEWS`` faster than the token buckets in
+    ``POLLS_RATE_LIMIT_CLIENT`` and ``POLLS_RATE_LIMIT_POLL`` allow.
+    """
+
+    def __init__(self):
+        self.views = set(getattr(settings, 'POLLS_RATE_LIMIT_VIEWS',
+            ('polls:detail',)))
+        self.client_limit = getattr(settings, 'POLLS_RATE_LIMIT_CLIENT',
+            (10, 60))
+        self.poll_limit = getattr(settings, 'POLLS_RATE_LIMIT_POLL', None)
+        self.buckets = TokenBuckets(
+            getattr(settings, 'POLLS_RATE_LIMIT_CACHE', 'default'))
+
+    def client_key(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            return 'user:%s' % user.pk
+        return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method != 'POST':
+            return None
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return None
+        view_name = '%s:%s' % (match.namespace, match.url_name)
+        if view_name not in self.views:
+            return None
+        limits = {}
+        if self.client_limit:
+            limits['polls:rate:%s:%s' % (
+                view_name, self.client_key(request))] = self.client_limit
+        pk = view_kwargs.get('pk')
+        if self.poll_limit and pk is not None:
+            limits['polls:rate:%s:poll:%s' % (view_name, pk)] = \
+                self.poll_limit
+        if not limits:
+            return None
+        wait = self.buckets.take(limits)
+        if not wait:
+            return None
+        response = HttpResponse("Too many votes, please try again later.",
+            status=429, content_type='text/plain')
+        response['Retry-After'] = str(int(math.ceil(wait)))
+        return response
+
+
+class RequestTiming(object):
+    """
+    What one sampled request spent its time on
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.view = None
+        self.render_start = None
+        self.render = 0.0
+        # where each connection's query log was when the request started
+        self.debug_cursors = {}
+        self.query_offsets = {}
+        for conn in connections.all():
+            self.debug_cursors[conn.alias] = conn.use_debug_cursor
+            conn.use_debug_cursor = True
+            self.query_offsets[conn.alias] = len(conn.queries)
+
+    def finish(self):
+        """
+        Stops recording queries and returns the timings in milliseconds
+        """
+        queries = 0
+        sql = 0.0
+        for conn in connections.all():
+            if conn.alias not in self.query_offsets:
+                continue
+            logged = conn.queries[self.query_offsets[conn.alias]:]
+            queries += len(logged)
+            sql += sum(float(query['time']) for query in logged)
+            conn.use_debug_cursor = self.debug_cursors[conn.alias]
+        return {
+            'view': self.view,
+            'queries': queries,
+            'sql': round(sql * 1000, 2),
+            'render': round(self.render * 1000, 2),
+            'total': round((time.time() - self.start) * 1000, 2),
+        }
+
+
+class RequestTimingMiddleware(object):
+    """
+    Times a ``POLLS_TIMING_SAMPLE_RATE`` share of requests. A sampled
+    request is logged to ``mysite.log`` as one JSON object with its view
+    name, query count, SQL time, template render time and total time,
+    and its response gets a ``Server-Timing`` header with the same
+    numbers for the browser's developer tools.
+
+    Put it first in ``MIDDLEWARE_CLASSES`` so the total includes the
+    other middleware. Render times are only known for TemplateResponses,
+    which every polls view returns.
+    """
+
+    def __init__(self):
+        self.sample_rate = getattr(settings, 'POLLS_TIMING_SAMPLE_RATE', 0)
+
+    def process_request(self, request):
+        if self.sample_rate and random.random() < self.sample_rate:
+            request.timing = RequestTiming()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = getattr(request, 'timing', None)
+        if timing is None:
+            return None
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name:
+            timing.view = ':'.join(filter(None,
+                [match.namespace, match.url_name]))
+        else:
+            timing.view = '%s.%s' % (view_func.__module__,
+                getattr(view_func, '__name__', type(view_func).__name__))
+        return None
+
+    def process_template_response(self, request, response):
+        timing = getattr(request, 'timing', None)
+        if timing is not None:
+            # the response is rendered right after the template
+            # response middleware
+            timing.render_start = time.time()
+
+            def rendered(response):
+                timing.render = time.time() - timing.render_start
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        timing = getattr(request, 'timing', None)
+        if timing is None:
+            return response
+        del request.timing
+        stats = timing.finish()
+        stats.update(method=request.method, path=request.path,
+            status=response.status_code)
+        logger.info(json.dumps(stats, sort_keys=True))
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%s;desc="%s queries"' % (stats['sql'], stats['queries']),
+            'render;dur=%s' % stats['render'],
+            'total;dur=%s' % stats['total'],
+        ])
+        return response
+
+
+class ReplicaPinMiddleware(object):
+    """
+    Reads from the primary database during requests that can write and,
+    through a cookie, during the same client's requests for
+    ``POLLS_REPLICA_STICKY_SECONDS`` after one of them succeeded.
+    """
+    cookie_name = 'polls_primary'
+
+    def process_request(self, request):
+        if (request.method not in ('GET', 'HEAD', 'OPTIONS')
+                or self.cookie_name in request.COOKIES):
+            routers.pin()
+            request.replica_pinned = True
+        return None
+
+    def process_response(self, request, response):
+        if getattr(request, 'replica_pinned', False):
+            routers.unpin()
+            request.replica_pinned = False
+        if (request.method not in ('GET', 'HEAD', 'OPTIONS')
+                and response.status_code < 400
+                and getattr(settings, 'POLLS_READ_REPLICAS', ())):
+            response.set_cookie(self.cookie_name, '1',
+                max_age=getattr(settings, 'POLLS_REPLICA_STICKY_SECONDS', 10),
+                httponly=True)
+        return response
@@ -1,28 +1,215 @@
 import datetime
+import json
+import random
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
-from django.db import models
-from django.db.models import Count
+from django.db import models, transaction, IntegrityError
+from django.db.backends.signals import connection_created
+from django.db.models import Count, F, Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.contrib.contenttypes.models import ContentType
+import django_comments
+from polls import caching
+from polls import live
 
 
 class PollManager(models.Manager):
     def published(self):
+        # a poll past its close_date takes no votes even before
+        # close_due() gets to it
+        now = timezone.now()
         return self.model.objects.filter(
-            pub_date__lte=timezone.now()).annotate(
-                num_choices=Count('choices')).filter(
-                    num_choices__gte=2).distinct()
+            Q(close_date__isnull=True) | Q(close_date__gt=now),
+            state=Poll.LIVE, pub_date__lte=now, choice_count__gte=2)
+
+    def next_publication(self):
+        """
+        The pub_date of the next poll that will appear in published()
+        """
+        return self.filter(state=Poll.SCHEDULED,
+            choice_count__gte=2).order_by('pub_date').values_list(
+                'pub_date', flat=True).first()
+
+    def with_results(self):
+        """
+        The polls with a results page, published and closed ones
+        """
+        return self.model.objects.filter(state__in=(Poll.LIVE, Poll.CLOSED),
+            pub_date__lte=timezone.now(), choice_count__gte=2)
+
+    def promote(self, now=None, pk=None):
+        """
+        Makes the scheduled polls whose pub_date has come live, only
+        poll ``pk`` if it is given. Returns how many there were.
+        """
+        polls = self.filter(state=Poll.SCHEDULED,
+            pub_date__lte=now or timezone.now())
+        if pk is not None:
+            polls = polls.filter(pk=pk)
+        return polls.update(state=Poll.LIVE)
+
+    def next_closing(self):
+        """
+        The close_date of the next live poll to close
+        """
+        return self.filter(state=Poll.LIVE, close_date__isnull=False
+            ).order_by('close_date').values_list(
+                'close_date', flat=True).first()
+
+    def close_due(self, now=None):
+        """
+        Closes the live polls whose close_date has come.
+        Returns how many there were.
+        """
+        return self.close(list(self.filter(state=Poll.LIVE,
+            close_date__lte=now or timezone.now()).values_list(
+                'id', flat=True)))
+
+    def close(self, ids, chunk_size=500):
+        """
+        Closes the polls with ``ids`` and freezes their results into
+        ResultsSnapshots, ``chunk_size`` polls per transaction.
+        Buffered and sharded votes are counted first.
+        """
+        from polls import buffer as vote_buffer
+        if not ids:
+            return 0
+        if vote_buffer.enabled():
+            vote_buffer.flush()
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            with transaction.atomic():
+                # no more votes, they only go to published() polls
+                self.filter(pk__in=chunk).update(state=Poll.CLOSED)
+                ChoiceShard.objects.fold(polls=chunk)
+                ResultsSnapshot.objects.freeze(chunk)
+            for poll_id in chunk:
+                caching.invalidate(caching.poll(poll_id))
+                caching.invalidate(caching.choices(poll_id))
+        caching.invalidate('index')
+        return len(ids)
+
+    def update_choice_counts(self):
+        """
+        Recounts ``choice_count`` for every poll, for rows that were
+        changed without the Choice signals (``bulk_create``, raw SQL
+        or databases created before the column existed).
+        """
+        counts = {}
+        for poll_id, num_choices in Choice.objects.values_list(
+                'poll').annotate(Count('id')).order_by():
+            counts.setdefault(num_choices, []).append(poll_id)
+        with transaction.atomic():
+            self.update(choice_count=0)
+            for num_choices, ids in counts.items():
+                self.filter(pk__in=ids).update(choice_count=num_choices)
+        return sum(len(ids) for ids in counts.values())
+
+
+def rank_choices(choices):
+    """
+    Gives each of ``choices`` its ``percent`` of the votes and its
+    ``rank``, see ``Poll.results()``. Returns ``(choices, total_votes)``.
+    """
+    total = sum(choice.votes for choice in choices)
+    ranked = sorted(choices, key=lambda choice: -choice.votes)
+    for position, choice in enumerate(ranked):
+        if position and choice.votes == ranked[position - 1].votes:
+            choice.rank = ranked[position - 1].rank
+        else:
+            choice.rank = position + 1
+        choice.percent = round(
+            100.0 * choice.votes / total, 1) if total else 0
+    return choices, total
+
+
+def choice_result(choice):
+    """
+    A ranked choice as a dict, as the snapshots and results.json have it
+    """
+    return {
+        'id': choice.id,
+        'choice_text': choice.choice_text,
+        'votes': choice.votes,
+        'percent': choice.percent,
+        'rank': choice.rank,
+    }
 
 
 class Poll(models.Model):
+    DRAFT = 'draft'
+    SCHEDULED = 'scheduled'
+    LIVE = 'live'
+    CLOSED = 'closed'
+    STATES = (
+        (DRAFT, _('Draft')),
+        (SCHEDULED, _('Scheduled')),
+        (LIVE, _('Live')),
+        (CLOSED, _('Closed')),
+    )
+
     question = models.CharField(_('question field'), max_length=200)
     pub_date = models.DateTimeField(_('date published'))
+    # saving moves a poll between scheduled and live by its pub_date,
+    # promote() makes scheduled polls live when their time comes and
+    # close_due() closes live polls at their close_date
+    state = models.CharField(max_length=10, choices=STATES, default=SCHEDULED,
+        help_text=_("Drafts and closed polls are not shown. Scheduled "
+            "polls go live at their publication date"))
+    close_date = models.DateTimeField(_('date closed'), null=True,
+        blank=True, help_text=_("Voting stops and the results are frozen "
+            "at this date"))
     max_answers = models.IntegerField(
         default=1, help_text=_("The number of answers per poll vote"))
+    vote_shards = models.PositiveIntegerField(
+        default=1, help_text=_("Spread votes over this many counters "
+            "for each choice. Use more than 1 for high traffic polls"))
+    # kept up to date by the Choice signals at the bottom of this module
+    # so published() doesn't have to join and count choices
+    choice_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = PollManager()
 
     class Meta:
         ordering = ["-pub_date", "question"]
+        index_together = [
+            # published(), the rows of the other states are never read
+            ['state', 'pub_date', 'choice_count'],
+            # next_closing() and close_due()
+            ['state', 'close_date'],
+            # keyset pagination, see polls.pagination
+            ['pub_date', 'id'],
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.state in (self.SCHEDULED, self.LIVE):
+            self.state = (self.LIVE if self.pub_date <= timezone.now()
+                else self.SCHEDULED)
+        if not self._state.adding and not args and not kwargs.get(
+                'force_insert') and kwargs.get('update_fields') is None:
+            # the choice signals keep choice_count with UPDATEs, the copy
+            # on this instance can be out of date
+            kwargs['update_fields'] = [field.name
+                for field in self._meta.local_fields
+                if not field.primary_key and field.name != 'choice_count']
+        super(Poll, self).save(*args, **kwargs)
+
+    def close(self):
+        Poll.objects.close([self.pk])
+        self.state = self.CLOSED
+
+    def frozen_results(self):
+        """
+        The ResultsSnapshot of a closed poll, or None
+        """
+        if self.state != self.CLOSED:
+            return None
+        try:
+            return self.snapshot
+        except ResultsSnapshot.DoesNotExist:
+            return None
 
     def was_published_recently(self):
         now = timezone.now()
@@ -32,21 +219,376 @@ class Poll(models.Model):
     was_published_recently.boolean = True
     was_published_recently.short_description = _('Published recently?')
 
+    def results(self):
+        """
+        Returns ``(choices, total_votes)`` from a single query of the
+        choices. Each choice gets a ``percent`` of the total votes and a
+        ``rank``, 1 for the most votes, with ties sharing a rank.
+        """
+        return rank_choices(list(self.choices.all()))
+
+    def final_results(self):
+        """
+        Returns ``(choices, total_votes)`` like ``results()`` with each
+        choice as a dict, from the snapshot if the poll is closed
+        """
+        snapshot = self.frozen_results()
+        if snapshot is not None:
+            return snapshot.choice_list(), snapshot.total_votes
+        choices, total_votes = self.results()
+        return [choice_result(choice) for choice in choices], total_votes
+
     def __unicode__(self):
         return self.question
 
 
+class ChoiceManager(models.Manager):
+    def record_votes(self, choices, shards=1, fingerprint=''):
+        """
+        Adds one vote to every choice in ``choices`` with a single UPDATE.
+        The increment is done by the database so concurrent voters
+        can't overwrite each other's votes.
+
+        With more than one shard the vote goes to a random
+        ``ChoiceShard`` instead, so voters don't all wait on the
+        same ``Choice`` rows.
+
+        Every vote is also added to the ``Vote`` log, call this in a
+        transaction so the count and the log can't disagree.
+        """
+        if shards > 1:
+            updated = ChoiceShard.objects.record_votes(
+                choices, random.randrange(shards))
+        else:
+            updated = self.filter(pk__in=[c.pk for c in choices]).update(
+                votes=F('votes') + 1)
+            self.votes_changed(set(c.poll_id for c in choices))
+        Vote.objects.log(choices, fingerprint)
+        return updated
+
+    def votes_changed(self, poll_ids):
+        """
+        Moves the cache version of the polls on, see ``polls.caching``,
+        and tells the live results streams
+        """
+        for poll_id in poll_ids:
+            caching.invalidate(caching.poll(poll_id))
+            live.publish(poll_id)
+
+
 class Choice(models.Model):
     poll = models.ForeignKey(Poll, related_name='choices')
     choice_text = models.CharField(max_length=200)
     votes = models.IntegerField(default=0)
+    # votes that aren't in the Vote log: pruned ones (see
+    # VoteManager.prune()) and ones counted before there was a log
+    archived_votes = models.IntegerField(default=0, editable=False)
+
+    objects = ChoiceManager()
 
     # http://toastdriven.com/blog/2011/apr/17/guide-to-testing-in-django-2/
     # if we needed to add logging when a vote is recoreded
     # then we only have to do it here
-    def record_vote(self):
-        self.votes += 1
-        self.save()
+    def record_vote(self, fingerprint=''):
+        """
+        Adds one vote with ``UPDATE ... SET votes = votes + 1``
+        instead of saving a value computed in Python.
+        ``self.votes`` is not refreshed, reload the choice to read it.
+        """
+        with transaction.atomic():
+            Choice.objects.record_votes(
+                [self], self.poll.vote_shards, fingerprint)
 
     def __unicode__(self):
         return self.choice_text
+
+
+class ChoiceShardManager(models.Manager):
+    def record_votes(self, choices, shard):
+        """
+        Adds one vote to counter ``shard`` of every choice in ``choices``,
+        creating the counters the first time they are used.
+        """
+        ids = set(c.pk for c in choices)
+        updated = self.filter(choice__in=ids, shard=shard).update(
+            votes=F('votes') + 1)
+        if updated < len(ids):
+            existing = set(self.filter(choice__in=ids, shard=shard)
+                .values_list('choice', flat=True))
+            for choice_id in ids - existing:
+                try:
+                    with transaction.atomic():
+                        self.create(choice_id=choice_id, shard=shard, votes=1)
+                except IntegrityError:
+                    # another voter created it first
+                    self.filter(choice=choice_id, shard=shard).update(
+                        votes=F('votes') + 1)
+        return len(ids)
+
+    def fold(self, poll=None, polls=None):
+        """
+        Moves the votes waiting in the shards into ``Choice.votes``,
+        for ``poll``, the poll ids in ``polls`` or every poll.
+        Only the counted votes are taken off each shard so votes
+        recorded while folding are kept for the next fold.
+        Returns the number of votes moved.
+        """
+        shards = self.filter(votes__gt=0)
+        if poll is not None:
+            shards = shards.filter(choice__poll=poll)
+        if polls is not None:
+            shards = shards.filter(choice__poll__in=polls)
+        totals = {}
+        poll_ids = set()
+        with transaction.atomic():
+            for pk, choice_id, poll_id, votes in shards.values_list(
+                    'pk', 'choice', 'choice__poll', 'votes'):
+                self.filter(pk=pk).update(votes=F('votes') - votes)
+                totals[choice_id] = totals.get(choice_id, 0) + votes
+                poll_ids.add(poll_id)
+            for choice_id, votes in totals.items():
+                Choice.objects.filter(pk=choice_id).update(
+                    votes=F('votes') + votes)
+        Choice.objects.votes_changed(poll_ids)
+        return sum(totals.values())
+
+
+class ChoiceShard(models.Model):
+    """
+    One of ``Poll.vote_shards`` vote counters for a choice.
+    The shards are added to ``Choice.votes`` by ``manage.py fold_votes``
+    so templates keep reading ``choice.votes``. Until then the results
+    leave the sharded votes out, keep it running with ``--interval``.
+    """
+    choice = models.ForeignKey(Choice, related_name='shards')
+    shard = models.PositiveIntegerField()
+    votes = models.IntegerField(default=0)
+
+    objects = ChoiceShardManager()
+
+    class Meta:
+        unique_together = ('choice', 'shard')
+
+    def __unicode__(self):
+        return u'%s #%s' % (self.choice, self.shard)
+
+
+class FlushedVoteBatch(models.Model):
+    """
+    A range of buffered votes that has been added to ``Choice.votes``.
+    See ``polls.buffer``.
+    """
+    key = models.CharField(max_length=50, unique=True)
+    flushed_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class VoteManager(models.Manager):
+    def log(self, choices, fingerprint='', timestamp=None):
+        """
+        Adds a Vote for every choice in ``choices`` with one INSERT
+        """
+        timestamp = timestamp or timezone.now()
+        return self.bulk_create([
+            self.model(poll_id=choice.poll_id, choice_id=choice.pk,
+                timestamp=timestamp, fingerprint=fingerprint)
+            for choice in choices])
+
+    def rebuild(self, poll=None):
+        """
+        Sets ``Choice.votes`` from the log (plus the votes pruned from it)
+        and takes the votes it read off the vote shards, which the log
+        already includes. The shards and choices are locked so votes wait
+        until the recount is done.
+        Returns the number of choices recounted.
+        """
+        choices = Choice.objects.select_for_update()
+        shards = ChoiceShard.objects.select_for_update().filter(votes__gt=0)
+        votes = self.all()
+        if poll is not None:
+            choices = choices.filter(poll=poll)
+            shards = shards.filter(choice__poll=poll)
+            votes = votes.filter(poll=poll)
+        with transaction.atomic():
+            # a shard vote is logged after its shard is updated, so the
+            # votes in the locked shards are all in the counts below
+            shards = list(shards.values_list('pk', 'votes'))
+            choices = list(choices)
+            counts = dict(votes.values_list('choice').annotate(
+                Count('id')).order_by())
+            for pk, shard_votes in shards:
+                ChoiceShard.objects.filter(pk=pk).update(
+                    votes=F('votes') - shard_votes)
+            for choice in choices:
+                Choice.objects.filter(pk=choice.pk).update(
+                    votes=choice.archived_votes + counts.get(choice.pk, 0))
+        Choice.objects.votes_changed(set(c.poll_id for c in choices))
+        return len(choices)
+
+    def prune(self, before, chunk_size=10000):
+        """
+        Deletes the votes older than ``before``, oldest first, in
+        transactions of ``chunk_size`` votes. Their counts are kept in
+        ``Choice.archived_votes`` so ``rebuild()`` still adds up.
+        Returns the number of votes deleted.
+        """
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                ids = list(self.filter(timestamp__lt=before).order_by(
+                    'timestamp').values_list('id', flat=True)[:chunk_size])
+                if not ids:
+                    return deleted
+                chunk = self.filter(pk__in=ids)
+                counts = {}
+                for choice_id, num_votes in chunk.values_list(
+                        'choice').annotate(Count('id')).order_by():
+                    counts.setdefault(num_votes, []).append(choice_id)
+                for num_votes, choice_ids in counts.items():
+                    Choice.objects.filter(pk__in=choice_ids).update(
+                        archived_votes=F('archived_votes') + num_votes)
+                chunk.delete()
+            deleted += len(ids)
+
+
+class Vote(models.Model):
+    """
+    One choice of one ballot. Votes are only ever added, except by
+    ``prune()``, so ``Choice.votes`` can be recounted with ``rebuild()``.
+    """
+    poll = models.ForeignKey(Poll, related_name='vote_log')
+    choice = models.ForeignKey(Choice, related_name='vote_log')
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+    # a hash of who voted, see polls.voters
+    fingerprint = models.CharField(max_length=40, blank=True)
+
+    objects = VoteManager()
+
+    class Meta:
+        index_together = [['poll', 'timestamp']]
+
+    def __unicode__(self):
+        return u'%s at %s' % (self.choice_id, self.timestamp)
+
+
+class ResultsSnapshotManager(models.Manager):
+    def freeze(self, poll_ids):
+        """
+        Stores the current results of the polls with ``poll_ids``,
+        replacing their old snapshots, from one query of their choices
+        """
+        choices = {}
+        for choice in Choice.objects.filter(poll__in=poll_ids):
+            choices.setdefault(choice.poll_id, []).append(choice)
+        snapshots = []
+        for poll_id in poll_ids:
+            listed, total = rank_choices(choices.get(poll_id, []))
+            snapshots.append(self.model(poll_id=poll_id, total_votes=total,
+                choices=json.dumps([choice_result(choice)
+                    for choice in listed])))
+        with transaction.atomic():
+            self.filter(poll__in=poll_ids).delete()
+            self.bulk_create(snapshots)
+        return len(snapshots)
+
+
+class ResultsSnapshot(models.Model):
+    """
+    The final results of a closed poll, so its results page is one
+    primary key lookup instead of a query of its choices
+    """
+    poll = models.OneToOneField(Poll, primary_key=True,
+        related_name='snapshot')
+    created = models.DateTimeField(auto_now_add=True)
+    total_votes = models.PositiveIntegerField()
+    # the choices as JSON with their votes, percent and rank
+    choices = models.TextField()
+
+    objects = ResultsSnapshotManager()
+
+    def choice_list(self):
+        return json.loads(self.choices)
+
+    def __unicode__(self):
+        return u'%s' % self.poll_id
+
+
+class Ballot(models.Model):
+    """
+    Someone has voted on a poll, see ``polls.dedupe``
+    """
+    poll = models.ForeignKey(Poll, related_name='ballots')
+    fingerprint = models.CharField(max_length=40)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('poll', 'fingerprint')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.poll_id, self.fingerprint)
+
+
+@receiver(pre_save, sender=Choice)
+def remember_choice_poll(sender, instance, raw, **kwargs):
+    # the poll a choice is moved away from loses a choice
+    instance._previous_poll_id = None
+    if instance.pk is not None and not raw:
+        instance._previous_poll_id = Choice.objects.filter(
+            pk=instance.pk).values_list('poll', flat=True).first()
+
+
+@receiver(post_save, sender=Choice)
+def count_saved_choice(sender, instance, created, raw, **kwargs):
+    if raw:
+        # fixtures already have the poll's choice_count
+        return
+    previous = getattr(instance, '_previous_poll_id', None)
+    if created:
+        Poll.objects.filter(pk=instance.poll_id).update(
+            choice_count=F('choice_count') + 1)
+    elif previous is not None and previous != instance.poll_id:
+        Poll.objects.filter(pk=previous).update(
+            choice_count=F('choice_count') - 1)
+        Poll.objects.filter(pk=instance.poll_id).update(
+            choice_count=F('choice_count') + 1)
+
+
+@receiver(post_delete, sender=Choice)
+def count_deleted_choice(sender, instance, **kwargs):
+    Poll.objects.filter(pk=instance.poll_id).update(
+        choice_count=F('choice_count') - 1)
+
+
+@receiver(post_save, sender=Poll)
+@receiver(post_delete, sender=Poll)
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def invalidate_caches(sender, instance, **kwargs):
+    poll_id = instance.pk if sender is Poll else instance.poll_id
+    caching.invalidate('index')
+    caching.invalidate(caching.poll(poll_id))
+    caching.invalidate(caching.choices(poll_id))
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Runs the ``POLLS_SQLITE_PRAGMAS`` on every new SQLite connection
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'POLLS_SQLITE_PRAGMAS', ())
+    if pragmas:
+        cursor = connection.connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+@receiver(post_save, sender=django_comments.get_model())
+@receiver(post_delete, sender=django_comments.get_model())
+def invalidate_comments(sender, instance, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Poll).pk:
+        caching.invalidate(caching.comments(instance.object_pk))
@@ -0,0 +1,69 @@
+"""
+Keyset (cursor) pagination for polls
+
+Pages are ordered newest first with ``id`` as a tiebreaker. A cursor
+holds the ``pub_date`` and ``id`` of the last poll on a page and the next
+page starts right after it, so a deep page is an index range scan instead
+of an OFFSET that reads and throws away earlier rows. Both columns run
+the same way so the rows can be read backwards off an index; ``question``
+from ``Poll.Meta.ordering`` would make SQLite sort them instead.
+"""
+import json
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+
+ORDERING = ('-pub_date', '-id')
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(poll):
+    data = json.dumps([poll.pub_date.isoformat(), poll.id])
+    return urlsafe_base64_encode(data.encode('utf-8'))
+
+
+def decode_cursor(cursor):
+    try:
+        pub_date, pk = json.loads(
+            urlsafe_base64_decode(str(cursor)).decode('utf-8'))
+        pub_date = parse_datetime(pub_date)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    # json can hand back any type, filter() would raise on some of them
+    if pub_date is None or type(pk) not in (int, long):
+        raise InvalidCursor(cursor)
+    return pub_date, pk
+
+
+def after(queryset, cursor):
+    """
+    Filters ``queryset`` down to the polls that come after ``cursor``
+    """
+    pub_date, pk = decode_cursor(cursor)
+    # The pub_date__lte bounds the index range, the OR alone can't.
+    # SQLite starts the range at the first bound on a column, so these
+    # go ahead of the queryset's own, such as published()'s
+    # pub_date__lte=now.
+    return queryset.model._default_manager.filter(
+        Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk),
+        pub_date__lte=pub_date) & queryset
+
+
+def page(queryset, cursor=None, per_page=5):
+    """
+    Returns ``(polls, next_cursor)`` for the page after ``cursor``
+    (the first page if it is ``None``). ``next_cursor`` is ``None``
+    on the last page.
+    """
+    queryset = queryset.order_by(*ORDERING)
+    if cursor:
+        queryset = after(queryset, cursor)
+    # one extra row tells us if there is another page
+    polls = list(queryset[:per_page + 1])
+    if len(polls) > per_page:
+        polls = polls[:per_page]
+        return polls, encode_cursor(polls[-1])
+    return polls, None
@@ -0,0 +1,74 @@
+"""
+Read replicas
+
+``ReplicaRouter`` sends reads of the polls models to a random database
+in ``POLLS_READ_REPLICAS`` and everything else to ``default``. Inside
+``primary()`` reads go to ``default`` too. ``ReplicaPinMiddleware``
+uses it for requests that write and for a client's requests for
+``POLLS_REPLICA_STICKY_SECONDS`` after it voted. Reads inside a transaction
+on ``default`` stay on ``default`` so they see what it wrote and can
+lock rows.
+
+Reads that are cached under a version (``caching.get()``, the page
+cache and the ETags of ``polls:results_json``) go to ``default`` as
+well. A replica can be behind the version, and what it returned would
+be served as that version until the next change.
+
+That leaves the replicas little: the archive pages and the poll lookups
+of comment pages and results streams. Vote counts and the poll and
+results pages all come from ``default`` or the cache, so the sticky
+cookie only keeps those few reads off the replicas after a vote. Other
+apps' models, the comments among them, are always read from ``default``.
+Until replicas get cache entries of their own with a short timeout,
+they take almost no load off ``default``.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_state = threading.local()
+
+
+def pinned():
+    return getattr(_state, 'pinned', 0) > 0
+
+
+def pin():
+    _state.pinned = getattr(_state, 'pinned', 0) + 1
+
+
+def unpin():
+    _state.pinned = max(getattr(_state, 'pinned', 0) - 1, 0)
+
+
+@contextmanager
+def primary():
+    """
+    Reads the polls models from the primary database
+    """
+    pin()
+    try:
+        yield
+    finally:
+        unpin()
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'polls' or pinned():
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        replicas = getattr(settings, 'POLLS_READ_REPLICAS', ())
+        if not replicas:
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
@@ -1,9 +1,44 @@
 import datetime
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from unittest import skipIf
 from django.utils import timezone
-from django.test import TestCase
+from django.utils.six import StringIO
+from django.db import connection, connections, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from polls.models import Poll, Choice
+from django.http import HttpResponse
+from django.test.client import Client, RequestFactory
+from django.utils.http import urlsafe_base64_encode
+from polls.models import Poll, Choice, ChoiceShard, Vote, Ballot
+from polls.models import ResultsSnapshot
+from polls.models import configure_sqlite
 from polls.forms import PollForm
+from polls import buffer as vote_buffer
+from polls import caching
+from polls import pagination
+from polls import live
+from polls import dedupe
+from polls.ingest import VoteImporter
+from polls.generate import generate
+from polls.middleware import TokenBuckets, ReplicaPinMiddleware
+from polls.routers import ReplicaRouter
+from polls.views import CSRF_PLACEHOLDER
+from polls import routers
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django_comments.models import Comment
+from polls import comments
 from django import forms
 # selenium tests
 from django.test import LiveServerTestCase
@@ -30,6 +65,15 @@ def assign_two_choices(poll):
     choice2 = Choice.objects.create(choice_text="choice two", poll=poll)
 
 
+def statements(queries, verb):
+    """
+    The SQL of the captured ``queries`` that are ``verb`` statements.
+    Django 1.6 logs SQLite queries as ``QUERY = u'...' - PARAMS = ...``.
+    """
+    return [q['sql'] for q in queries.captured_queries
+        if re.match(r"(QUERY = u?')?%s\b" % verb, q['sql'])]
+
+
 class PollMethodTests(TestCase):
 
     def test_was_published_recently_with_future_poll(self):
@@ -69,6 +113,52 @@ class PollMethodTests(TestCase):
             choice_text="only option", poll=invalid_poll)
         self.assertEqual(Poll.objects.published().count(), 0)
 
+    def test_choice_count(self):
+        """
+        Test that choice_count follows choices being added,
+        moved and deleted
+        """
+        poll = create_poll(question="counted", days=-1)
+        other = create_poll(question="other", days=-1)
+        assign_two_choices(poll)
+        self.assertEqual(Poll.objects.get(id=poll.id).choice_count, 2)
+        choice = poll.choices.all()[0]
+        choice.poll = other
+        choice.save()
+        self.assertEqual(Poll.objects.get(id=poll.id).choice_count, 1)
+        self.assertEqual(Poll.objects.get(id=other.id).choice_count, 1)
+        choice.choice_text = "renamed"
+        choice.save()
+        self.assertEqual(Poll.objects.get(id=other.id).choice_count, 1)
+        choice.delete()
+        self.assertEqual(Poll.objects.get(id=other.id).choice_count, 0)
+
+    def test_save_keeps_choice_count(self):
+        """
+        Test that saving a poll loaded before its choices were added
+        doesn't write back its old choice_count
+        """
+        poll = create_poll(question="stale", days=-1)
+        assign_two_choices(poll)
+        poll.question = "renamed"
+        poll.save()
+        self.assertEqual(Poll.objects.get(id=poll.id).choice_count, 2)
+        self.assertEqual(Poll.objects.published().count(), 1)
+
+    def test_update_choice_counts(self):
+        """
+        Test that update_choice_counts() fixes counts that were
+        changed without the signals
+        """
+        poll = create_poll(question="bulk", days=-1)
+        Choice.objects.bulk_create([
+            Choice(poll=poll, choice_text="one"),
+            Choice(poll=poll, choice_text="two")])
+        self.assertEqual(Poll.objects.published().count(), 0)
+        Poll.objects.update_choice_counts()
+        self.assertEqual(Poll.objects.get(id=poll.id).choice_count, 2)
+        self.assertEqual(Poll.objects.published().count(), 1)
+
     def test_unicode(self):
         """
         str(Poll) or unicode(Poll) should be the question
@@ -114,8 +204,25 @@ class ChoiceMethodTests(TestCase):
         self.assertEqual(Choice.objects.get(id=choice_1_id).votes, 2)
         self.assertEqual(Choice.objects.get(id=choice_2_id).votes, 1)
 
+    def test_record_vote_with_stale_instances(self):
+        """
+        Two copies of the same choice loaded before either votes
+        should not overwrite each other's vote
+        """
+        poll = create_poll(question="not important", days=-1)
+        choice = Choice.objects.create(choice_text="choice 1", poll=poll)
+        first = Choice.objects.get(id=choice.id)
+        second = Choice.objects.get(id=choice.id)
+        first.record_vote()
+        second.record_vote()
+        self.assertEqual(Choice.objects.get(id=choice.id).votes, 2)
+
 
 class PollIndexTests(TestCase):
+    def setUp(self):
+        super(PollIndexTests, self).setUp()
+        cache.clear()
+
     def test_index_view_with_no_polls(self):
         """
         If no polls exist, an appropriate message should be displayed.
@@ -216,6 +323,336 @@ class PollIndexTests(TestCase):
             [valid_poll.id])
 
 
+class IndexCacheTests(TestCase):
+    def setUp(self):
+        super(IndexCacheTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Cached poll.", days=-1)
+        assign_two_choices(self.poll)
+
+    def test_second_request_is_a_hit(self):
+        """
+        Test that the second index request doesn't query the database
+        """
+        self.client.get(reverse('polls:index'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('polls:index'))
+        self.assertContains(response, "Cached poll.")
+        self.assertEqual(caching.stats('index')['hits'], 1)
+        self.assertEqual(caching.stats('index')['misses'], 1)
+
+    def test_save_invalidates(self):
+        """
+        Test that changing a poll shows up on the next request
+        """
+        self.client.get(reverse('polls:index'))
+        self.poll.question = "Renamed poll."
+        self.poll.save()
+        response = self.client.get(reverse('polls:index'))
+        self.assertContains(response, "Renamed poll.")
+        self.assertEqual(caching.stats('index')['misses'], 2)
+
+    def test_choice_delete_invalidates(self):
+        """
+        Test that a poll left with one choice leaves the index
+        """
+        self.client.get(reverse('polls:index'))
+        self.poll.choices.all()[0].delete()
+        response = self.client.get(reverse('polls:index'))
+        self.assertContains(response, "No polls are available.")
+
+    def test_next_publication(self):
+        """
+        Test that the cached index expires when the next
+        publishable future poll is published
+        """
+        future = create_poll(question="Future poll.", days=2)
+        self.assertEqual(Poll.objects.next_publication(), None)
+        assign_two_choices(future)
+        self.assertEqual(Poll.objects.next_publication(), future.pub_date)
+
+    def test_expired_value_is_rebuilt(self):
+        """
+        Test that a value past its expiry is rebuilt
+        and bumps the version for fragments
+        """
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        self.assertEqual(caching.get('test', lambda: ('old', past)), 'old')
+        version = caching.version('test')
+        self.assertEqual(caching.get('test', lambda: ('new', None)), 'new')
+        self.assertEqual(caching.version('test'), version + 1)
+        self.assertEqual(caching.get('test', lambda: ('newer', None)), 'new')
+
+class PollStateTests(TestCase):
+    def setUp(self):
+        super(PollStateTests, self).setUp()
+        cache.clear()
+
+    def test_state_follows_pub_date(self):
+        """
+        Test that saving makes past polls live and future ones scheduled
+        but leaves drafts alone
+        """
+        poll = create_poll(question="Moved", days=-1)
+        self.assertEqual(poll.state, Poll.LIVE)
+        poll.pub_date = timezone.now() + datetime.timedelta(days=1)
+        poll.save()
+        self.assertEqual(poll.state, Poll.SCHEDULED)
+        poll.state = Poll.DRAFT
+        poll.pub_date = timezone.now() - datetime.timedelta(days=1)
+        poll.save()
+        self.assertEqual(poll.state, Poll.DRAFT)
+
+    def test_only_live_polls_are_published(self):
+        for state in (Poll.DRAFT, Poll.CLOSED):
+            poll = Poll.objects.create(question=state, state=state,
+                pub_date=timezone.now() - datetime.timedelta(days=1))
+            assign_two_choices(poll)
+        self.assertQuerysetEqual(Poll.objects.published(), [])
+
+    def test_promote(self):
+        """
+        Test that a scheduled poll goes live once its pub_date has come,
+        on the next index miss at the latest
+        """
+        poll = create_poll(question="Due poll.", days=1)
+        assign_two_choices(poll)
+        self.assertEqual(Poll.objects.promote(), 0)
+        Poll.objects.filter(pk=poll.pk).update(
+            pub_date=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertContains(self.client.get(reverse('polls:index')),
+            "Due poll.")
+        self.assertEqual(Poll.objects.get(pk=poll.pk).state, Poll.LIVE)
+        self.assertEqual(Poll.objects.promote(), 0)
+
+    def test_due_poll_detail(self):
+        """
+        Test that a poll's own pages appear at its pub_date without
+        waiting for promote_polls
+        """
+        poll = create_poll(question="Due poll.", days=1)
+        assign_two_choices(poll)
+        detail = reverse('polls:detail', args=(poll.id,))
+        self.assertEqual(self.client.get(detail).status_code, 404)
+        Poll.objects.filter(pk=poll.pk).update(
+            pub_date=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertContains(self.client.get(detail), "Due poll.")
+        self.assertEqual(Poll.objects.get(pk=poll.pk).state, Poll.LIVE)
+        other = create_poll(question="Other due poll.", days=1)
+        assign_two_choices(other)
+        Poll.objects.filter(pk=other.pk).update(
+            pub_date=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(self.client.get(reverse('polls:results_json',
+            args=(other.id,))).status_code, 200)
+
+    def test_missing_poll_is_not_promoted(self):
+        """
+        Test that a 404 for a poll that isn't due doesn't write
+        """
+        future = create_poll(question="Future poll.", days=1)
+        assign_two_choices(future)
+        for pk in (future.pk, future.pk + 100):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(
+                    reverse('polls:detail', args=(pk,)))
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(statements(queries, 'UPDATE'), [])
+
+
+class PollClosingTests(TestCase):
+    def setUp(self):
+        super(PollClosingTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Closing poll.", days=-2)
+        self.one = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.two = Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.one.record_vote()
+        self.one.record_vote()
+        self.two.record_vote()
+        self.results_url = reverse('polls:results', args=(self.poll.id,))
+
+    def test_close_freezes_results(self):
+        """
+        Test that a closed poll takes no votes and shows the results it
+        had when it closed, read from its snapshot alone
+        """
+        self.poll.close()
+        Choice.objects.filter(pk=self.one.pk).update(votes=100)
+        self.assertEqual(self.client.get(
+            reverse('polls:detail', args=(self.poll.id,))).status_code, 404)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.results_url)
+        self.assertFalse([q for q in queries.captured_queries
+            if 'polls_choice' in q['sql']])
+        self.assertEqual(response.context['total_votes'], 3)
+        self.assertEqual(
+            [(c['choice_text'], c['votes'], c['percent'], c['rank'])
+                for c in response.context['choices']],
+            [("One", 2, 66.7, 1), ("Two", 1, 33.3, 2)])
+        self.assertContains(response, "This poll is closed.")
+
+    def test_past_close_date_takes_no_votes(self):
+        """
+        Test that a poll stops taking votes at its close_date, before
+        anything has closed it
+        """
+        Poll.objects.filter(pk=self.poll.pk).update(
+            close_date=timezone.now() - datetime.timedelta(hours=1))
+        detail = reverse('polls:detail', args=(self.poll.id,))
+        self.assertEqual(self.client.get(detail).status_code, 404)
+        self.assertEqual(self.client.post(detail,
+            {'choice': self.one.id}).status_code, 404)
+        self.assertEqual(Choice.objects.get(pk=self.one.pk).votes, 2)
+
+    def test_closed_poll_takes_no_votes_on_results(self):
+        """
+        Test that votes can't be posted to the results page
+        """
+        self.poll.close()
+        response = self.client.post(self.results_url, {'choice': self.one.id})
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(Choice.objects.get(pk=self.one.pk).votes, 2)
+
+    def test_closed_poll_comments(self):
+        """
+        Test that older comments of a closed poll can still be loaded
+        """
+        self.poll.close()
+        response = self.client.get(
+            reverse('polls:comments', args=(self.poll.id,)) + '?page=2')
+        self.assertEqual(response.status_code, 200)
+
+    def test_closed_poll_json(self):
+        """
+        Test that results.json serves a closed poll from its snapshot
+        """
+        self.poll.close()
+        Choice.objects.filter(pk=self.one.pk).update(votes=100)
+        response = self.client.get(
+            reverse('polls:results_json', args=(self.poll.id,)))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['total_votes'], 3)
+        self.assertEqual([(c['id'], c['votes']) for c in data['choices']],
+            [(self.one.id, 2), (self.two.id, 1)])
+
+    def test_close_due(self):
+        """
+        Test that a poll closes at its close_date, on the next index
+        miss at the latest
+        """
+        self.poll.close_date = timezone.now() + datetime.timedelta(days=1)
+        self.poll.save()
+        self.assertEqual(Poll.objects.next_closing(), self.poll.close_date)
+        self.assertContains(self.client.get(reverse('polls:index')),
+            "Closing poll.")
+        Poll.objects.filter(pk=self.poll.pk).update(
+            close_date=timezone.now() - datetime.timedelta(minutes=1))
+        cache.clear()
+        self.assertNotContains(self.client.get(reverse('polls:index')),
+            "Closing poll.")
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual(poll.state, Poll.CLOSED)
+        self.assertEqual(poll.snapshot.total_votes, 3)
+
+    def test_backfill(self):
+        """
+        Test that snapshot_polls freezes closed polls without a snapshot
+        """
+        Poll.objects.filter(pk=self.poll.pk).update(state=Poll.CLOSED)
+        other = create_poll(question="Overdue poll.", days=-2)
+        assign_two_choices(other)
+        Poll.objects.filter(pk=other.pk).update(
+            close_date=timezone.now() - datetime.timedelta(days=1))
+        call_command('snapshot_polls', stdout=StringIO())
+        self.assertEqual(ResultsSnapshot.objects.count(), 2)
+        self.assertEqual(
+            ResultsSnapshot.objects.get(pk=self.poll.pk).total_votes, 3)
+        self.assertEqual(Poll.objects.get(pk=other.pk).state, Poll.CLOSED)
+
+
+class ArchiveViewTests(TestCase):
+    def setUp(self):
+        super(ArchiveViewTests, self).setUp()
+        cache.clear()
+        self.polls = []
+        for i in range(7):
+            poll = create_poll(question="Poll %s" % i, days=-i)
+            assign_two_choices(poll)
+            self.polls.append(poll)
+        # same pub_date and question as another poll, only id differs
+        twin = Poll.objects.create(question="Poll 3",
+            pub_date=self.polls[3].pub_date)
+        assign_two_choices(twin)
+        # the newer id comes first
+        self.polls.insert(3, twin)
+
+    def test_walk_all_pages(self):
+        """
+        Test that following the cursors visits every poll once, in order
+        """
+        seen = []
+        cursor = None
+        while True:
+            polls, cursor = pagination.page(
+                Poll.objects.published(), cursor, per_page=3)
+            seen.extend(p.id for p in polls)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [p.id for p in self.polls])
+
+    def test_deep_page_is_one_query(self):
+        """
+        Test that a later page is a single query like the first
+        """
+        polls, cursor = pagination.page(Poll.objects.published(), per_page=3)
+        polls, cursor = pagination.page(
+            Poll.objects.published(), cursor, per_page=3)
+        with self.assertNumQueries(1):
+            pagination.page(Poll.objects.published(), cursor, per_page=3)
+
+    def test_index_links_to_archive(self):
+        """
+        Test that the index links to the polls after the first five
+        """
+        response = self.client.get(reverse('polls:index'))
+        cursor = response.context['next_cursor']
+        response = self.client.get(reverse('polls:archive'), {'after': cursor})
+        self.assertEqual([p.id for p in response.context['poll_list']],
+            [p.id for p in self.polls[5:]])
+        self.assertEqual(response.context['next_cursor'], None)
+
+    def test_invalid_cursor(self):
+        """
+        Test that a cursor that can't be decoded is a 404
+        """
+        response = self.client.get(
+            reverse('polls:archive'), {'after': 'not a cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_wrong_types(self):
+        """
+        Test that a cursor that decodes to the wrong types is a 404
+        """
+        for values in ([self.polls[0].pub_date.isoformat(), None],
+                [self.polls[0].pub_date.isoformat(), "1"], [None, 1]):
+            cursor = urlsafe_base64_encode(json.dumps(values))
+            response = self.client.get(
+                reverse('polls:archive'), {'after': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_json(self):
+        """
+        Test the JSON version of the archive
+        """
+        response = self.client.get(reverse('polls:archive_json'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(response.content)
+        self.assertEqual([p['id'] for p in data['polls']],
+            [p.id for p in self.polls])
+        self.assertEqual(data['next'], None)
+
 class PollDetailViewTests(TestCase):
     def test_detail_view_with_a_future_poll(self):
         """
@@ -262,6 +699,8 @@ class PollVoteViewTests(TestCase):
         #TODO: and why does it contain the name?
         #TODO: why can't it just be super and copy and paste friendly
         super(PollVoteViewTests, self).setUp()  # don't forget this
+        # start with full rate limit buckets
+        cache.clear()
         self.multi_answer_poll = Poll.objects.create(
             question="Can you submit more than one answer",
             pub_date=timezone.now(),
@@ -441,6 +880,71 @@ class PollVoteViewTests(TestCase):
 
     #TODO: test that required is red?
 
+
+class PollQueryCountTests(TestCase):
+    """
+    Pin the number of queries a vote costs so extra lookups get noticed
+    """
+    def setUp(self):
+        super(PollQueryCountTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Query count", days=-1)
+        self.choice = Choice.objects.create(choice_text="One", poll=self.poll)
+        Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:detail', args=(self.poll.id,))
+
+    def assertNumQueriesWithoutSavepoints(self, num, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = func(*args, **kwargs)
+        sql = [q['sql'] for q in queries.captured_queries
+            if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(sql), num, '\n'.join(sql))
+        return response
+
+    def test_cold_get(self):
+        """
+        The poll and its choices, which are then cached
+        """
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_get(self):
+        """
+        None, the page is cached
+        """
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_valid_post(self):
+        """
+        The poll, the UPDATE and the Vote log INSERT
+        """
+        self.client.get(self.url)
+        response = self.assertNumQueriesWithoutSavepoints(
+            3, self.client.post, self.url, {'choice': self.choice.id})
+        self.assertEqual(response.status_code, 302)
+
+    def test_invalid_post(self):
+        """
+        The poll
+        """
+        self.client.get(self.url)
+        response = self.assertNumQueriesWithoutSavepoints(
+            1, self.client.post, self.url, {'choice': 0})
+        self.assertEqual(response.status_code, 200)
+
+    def test_choice_change_is_seen(self):
+        """
+        Test that a choice added in the admin shows up in the cached form
+        """
+        self.client.get(self.url)
+        Choice.objects.create(choice_text="Three", poll=self.poll)
+        response = self.client.get(self.url)
+        self.assertContains(response, "Three")
+
 class PollResultsViewTests(TestCase):
     def test_no_poll(self):
         """
@@ -460,6 +964,39 @@ class PollResultsViewTests(TestCase):
         self.assertEqual(response.context['poll'].id, poll.id)
         self.assertEqual(response.context['poll'].question, "Valid Poll")
 
+    def test_percentages_and_ranks(self):
+        """
+        Test that every choice has its share of the votes and a rank
+        """
+        poll = create_poll(question="Valid Poll", days=-1)
+        Choice.objects.create(choice_text="a", poll=poll, votes=1)
+        Choice.objects.create(choice_text="b", poll=poll, votes=2)
+        Choice.objects.create(choice_text="c", poll=poll, votes=1)
+        response = self.client.get(reverse('polls:results', args=(poll.id,)))
+        self.assertEqual(response.context['total_votes'], 4)
+        self.assertEqual(
+            [(c.choice_text, c.percent, c.rank)
+                for c in response.context['choices']],
+            [("a", 25.0, 2), ("b", 50.0, 1), ("c", 25.0, 2)])
+        self.assertContains(response, "50.0%")
+
+    def test_query_count_does_not_grow_with_choices(self):
+        """
+        Test that the results page costs the same number of queries
+        for 2 and 20 choices
+        """
+        counts = []
+        for num_choices in (2, 20):
+            poll = create_poll(question="Valid Poll", days=-1)
+            for i in range(num_choices):
+                Choice.objects.create(choice_text=str(i), poll=poll)
+            url = reverse('polls:results', args=(poll.id,))
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
     def test_invalid_poll(self):
         """
         Test that an invalid poll gives a 404 page
@@ -475,6 +1012,638 @@ class PollResultsViewTests(TestCase):
             reverse('polls:results', args=(invalid_poll2.id,)))
         self.assertEqual(response.status_code, 404)
 
+class PageCacheTests(TestCase):
+    def setUp(self):
+        super(PageCacheTests, self).setUp()
+        cache.clear()
+        dedupe.reset()
+        self.poll = create_poll(question="Cached page", days=-1)
+        self.choice = Choice.objects.create(choice_text="One", poll=self.poll)
+        Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:detail', args=(self.poll.id,))
+        self.results_url = reverse('polls:results', args=(self.poll.id,))
+
+    def assertOwnCsrfToken(self, response):
+        self.assertNotContains(response, CSRF_PLACEHOLDER)
+        self.assertContains(response, response.cookies['csrftoken'].value)
+
+    def test_csrf_token(self):
+        """
+        Test that a cached page gets each visitor's own CSRF token
+        """
+        self.assertOwnCsrfToken(self.client.get(self.url))
+        other = Client()
+        with self.assertNumQueries(0):
+            response = other.get(self.url)
+        self.assertOwnCsrfToken(response)
+        self.assertNotEqual(response.cookies['csrftoken'].value,
+            self.client.cookies['csrftoken'].value)
+
+    def test_vote_changes_results(self):
+        """
+        Test that the cached results page is replaced after a vote but
+        the poll page isn't
+        """
+        self.client.get(self.url)
+        self.assertContains(self.client.get(self.results_url), "0 votes")
+        self.choice.record_vote()
+        self.assertContains(self.client.get(self.results_url), "1 vote ")
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+    def test_messages_are_not_cached(self):
+        """
+        Test that a page with a message for the visitor is not cached
+        """
+        with self.settings(POLLS_DEDUPE_VOTES=True):
+            self.client.post(self.url, {'choice': self.choice.id})
+            response = self.client.post(self.url, {'choice': self.choice.id},
+                follow=True)
+        self.assertContains(response, "already voted")
+        self.assertNotContains(Client().get(self.results_url),
+            "already voted")
+
+    def test_missing_polls_start_no_versions(self):
+        """
+        Test that requests for polls that aren't there leave no
+        versions in the cache
+        """
+        pk = self.poll.id + 100
+        for name in ('polls:detail', 'polls:results', 'polls:results_json'):
+            response = self.client.get(reverse(name, args=(pk,)))
+            self.assertEqual(response.status_code, 404)
+        for name in (caching.poll(pk), caching.choices(pk),
+                caching.comments(pk)):
+            self.assertEqual(caching.version(name, create=False), None)
+
+    @override_settings(POLLS_PAGE_CACHE_LOG_EVERY=2)
+    def test_hit_rate_logged(self):
+        caching._page_lookups.clear()
+        handler = ListHandler()
+        logging.getLogger('mysite.log').addHandler(handler)
+        try:
+            self.client.get(self.url)
+            self.client.get(self.url)
+        finally:
+            logging.getLogger('mysite.log').removeHandler(handler)
+        self.assertTrue(
+            "page:detail cache: 50.0% hits over 2 requests" in handler.messages)
+        self.assertEqual(caching.stats('page:detail')['hits'], 1)
+
+
+class CommentCacheTests(TestCase):
+    def setUp(self):
+        super(CommentCacheTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Discussed", days=-1)
+        assign_two_choices(self.poll)
+        self.url = reverse('polls:results', args=(self.poll.id,))
+
+    def comment(self, text):
+        return Comment.objects.create(
+            content_type=ContentType.objects.get_for_model(Poll),
+            object_pk=str(self.poll.pk), site_id=settings.SITE_ID,
+            user_name="voter", comment=text, submit_date=timezone.now())
+
+    def test_count_is_cached(self):
+        """
+        Test that the comment count is cached until a comment is
+        posted or removed
+        """
+        self.comment("first")
+        self.assertEqual(comments.count(self.poll), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(comments.count(self.poll), 1)
+        second = self.comment("second")
+        self.assertEqual(comments.count(self.poll), 2)
+        second.is_removed = True
+        second.save()
+        self.assertEqual(comments.count(self.poll), 1)
+        Comment.objects.all().delete()
+        self.assertEqual(comments.count(self.poll), 0)
+
+    @override_settings(POLLS_COMMENTS_PER_PAGE=2)
+    def test_older_comments(self):
+        """
+        Test that the results page shows the newest comments and links
+        to the older ones
+        """
+        for text in ("oldest", "older", "newer", "newest"):
+            self.comment(text)
+        response = self.client.get(self.url)
+        self.assertContains(response, "4 comments")
+        self.assertContains(response, "newest")
+        self.assertNotContains(response, "oldest")
+        self.assertContains(response, "?page=2")
+        response = self.client.get(
+            reverse('polls:comments', args=(self.poll.id,)), {'page': 2})
+        self.assertContains(response, "oldest")
+        self.assertNotContains(response, "newest")
+        self.assertNotContains(response, "?page=3")
+
+    def test_new_comment_shows_up(self):
+        """
+        Test that the cached comment list is rebuilt for a new comment
+        """
+        self.client.get(self.url)
+        self.comment("fresh")
+        self.assertContains(self.client.get(self.url), "fresh")
+
+    def test_bad_page(self):
+        url = reverse('polls:comments', args=(self.poll.id,))
+        self.assertEqual(self.client.get(url, {'page': 'x'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'page': 9}).status_code, 200)
+
+
+class ResultsJSONTests(TestCase):
+    def setUp(self):
+        super(ResultsJSONTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Dashboard", days=-1)
+        self.choice1 = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.choice2 = Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:results_json', args=(self.poll.id,))
+
+    def test_counts(self):
+        """
+        Test that the JSON has the vote counts
+        """
+        self.choice1.record_vote()
+        response = self.client.get(self.url)
+        data = json.loads(response.content)
+        self.assertEqual(data['total_votes'], 1)
+        self.assertEqual([(c['id'], c['votes']) for c in data['choices']],
+            [(self.choice1.id, 1), (self.choice2.id, 0)])
+
+    def test_not_modified(self):
+        """
+        Test that an unchanged ETag gets a 304 without any queries
+        """
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_vote_changes_etag(self):
+        """
+        Test that a vote gives the results a new ETag
+        """
+        etag = self.client.get(self.url)['ETag']
+        PollForm({'choice': self.choice2.id}, instance=self.poll).save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_evicted_version_changes_etag(self):
+        """
+        Test that a version evicted from the cache doesn't come back
+        with an ETag that was already handed out
+        """
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url)['ETag'], etag)
+        time.sleep(0.002)
+        cache.delete(caching._key(caching.poll(self.poll.id), 'version'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_long_poll(self):
+        """
+        Test that ?wait= holds an unchanged ETag until the time is up
+        and answers a stale one right away
+        """
+        etag = self.client.get(self.url)['ETag']
+        start = time.time()
+        response = self.client.get(self.url, {'wait': 0.2},
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.choice1.record_vote()
+        response = self.client.get(self.url, {'wait': 10},
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_unpublished_poll(self):
+        """
+        Test that a poll that is not published is a 404
+        """
+        poll = create_poll(question="Future", days=5)
+        assign_two_choices(poll)
+        response = self.client.get(
+            reverse('polls:results_json', args=(poll.id,)))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(POLLS_LIVE_BROKER='polls.live.MemoryBroker',
+    POLLS_LIVE_MAX_RATE=1000, POLLS_LIVE_HEARTBEAT=0.01)
+class ResultsStreamTests(TestCase):
+    def setUp(self):
+        super(ResultsStreamTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Live", days=-1)
+        self.choice = Choice.objects.create(choice_text="One", poll=self.poll)
+        Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:results_stream', args=(self.poll.id,))
+
+    def events(self, response):
+        for chunk in response.streaming_content:
+            if chunk.startswith('id:'):
+                lines = chunk.splitlines()
+                yield int(lines[0][4:]), json.loads(lines[2][6:])
+
+    def test_stream(self):
+        """
+        Test that the stream sends the results and again after a vote
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.events(response)
+        first_version, data = next(events)
+        self.assertEqual(data['total_votes'], 0)
+        PollForm({'choice': self.choice.id}, instance=self.poll).save()
+        version, data = next(events)
+        self.assertTrue(version > first_version)
+        self.assertEqual(data['total_votes'], 1)
+
+    def test_last_event_id(self):
+        """
+        Test that a reconnecting client only gets newer results
+        """
+        version = caching.version(caching.poll(self.poll.id))
+        response = self.client.get(self.url, HTTP_LAST_EVENT_ID=str(version))
+        chunks = response.streaming_content
+        next(chunks)
+        self.assertEqual(next(chunks), ': keepalive\n\n')
+
+    def test_memory_broker_wakes_waiters(self):
+        """
+        Test that publishing wakes a subscriber before its timeout
+        """
+        broker = live.MemoryBroker()
+        version = caching.version(caching.poll(self.poll.id))
+        timer = threading.Timer(0.05, lambda: (
+            caching.invalidate(caching.poll(self.poll.id)),
+            broker.publish(self.poll.id)))
+        timer.start()
+        start = datetime.datetime.now()
+        self.assertNotEqual(broker.wait(self.poll.id, version, 5), version)
+        self.assertTrue(datetime.datetime.now() - start
+            < datetime.timedelta(seconds=5))
+
+
+class VoteImportTests(TestCase):
+    def setUp(self):
+        super(VoteImportTests, self).setUp()
+        self.poll = Poll.objects.create(
+            question="Paper ballots", pub_date=timezone.now(), max_answers=2)
+        self.choice1 = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.choice2 = Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.choice3 = Choice.objects.create(
+            choice_text="Three", poll=self.poll)
+        self.future_poll = create_poll(question="Future", days=5)
+        assign_two_choices(self.future_poll)
+
+    def votes(self):
+        return [Choice.objects.get(id=c.id).votes
+            for c in (self.choice1, self.choice2, self.choice3)]
+
+    def test_ndjson(self):
+        """
+        Test that valid ballots are counted and invalid ones reported
+        """
+        other = self.future_poll.choices.all()[0]
+        lines = [
+            json.dumps({'poll': self.poll.id, 'choice': self.choice1.id}),
+            json.dumps({'poll': self.poll.id,
+                'choices': [self.choice1.id, self.choice2.id]}),
+            '',
+            json.dumps({'poll': self.poll.id, 'choices': [self.choice1.id,
+                self.choice2.id, self.choice3.id]}),
+            json.dumps({'poll': self.poll.id, 'choice': other.id}),
+            json.dumps({'poll': self.future_poll.id, 'choice': other.id}),
+            json.dumps({'poll': self.poll.id, 'choices': []}),
+            'not json',
+        ]
+        report = VoteImporter(chunk_size=1).run(lines)
+        self.assertEqual(report['accepted'], 2)
+        self.assertEqual(report['rejected'], 5)
+        self.assertEqual([e['line'] for e in report['errors']],
+            [4, 5, 6, 7, 8])
+        self.assertTrue("Too many" in report['errors'][0]['error'])
+        self.assertEqual(self.votes(), [2, 1, 0])
+
+    def test_csv(self):
+        """
+        Test that CSV rows are the poll id followed by choice ids
+        """
+        lines = ['poll,choice',
+            '%s,%s' % (self.poll.id, self.choice3.id),
+            '%s,%s,%s' % (self.poll.id, self.choice2.id, self.choice3.id)]
+        report = VoteImporter().run(lines, 'csv')
+        self.assertEqual(report['accepted'], 2)
+        self.assertEqual(self.votes(), [0, 1, 2])
+
+    def test_endpoint(self):
+        """
+        Test that only users who can change choices can import votes
+        """
+        url = reverse('polls:import_votes')
+        body = '%s,%s\n' % (self.poll.id, self.choice1.id)
+        response = self.client.post(url, body, content_type='text/csv')
+        self.assertEqual(response.status_code, 403)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        response = self.client.post(url, body, content_type='text/csv')
+        self.assertEqual(json.loads(response.content)['accepted'], 1)
+        self.assertEqual(self.votes(), [1, 0, 0])
+
+
+class VoteLogTests(TestCase):
+    def setUp(self):
+        super(VoteLogTests, self).setUp()
+        cache.clear()
+        self.poll = Poll.objects.create(
+            question="Logged", pub_date=timezone.now(), max_answers=2)
+        self.choice1 = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.choice2 = Choice.objects.create(choice_text="Two", poll=self.poll)
+
+    def vote(self, *choices):
+        PollForm({'choice': [c.id for c in choices]},
+            instance=self.poll).save('voter')
+
+    def test_votes_are_logged(self):
+        """
+        Test that every choice of a ballot is logged with one INSERT
+        """
+        form = PollForm({'choice': [self.choice1.id, self.choice2.id]},
+            instance=self.poll)
+        self.assertTrue(form.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            form.save('voter')
+        self.assertEqual(len(statements(queries, 'INSERT')), 1)
+        self.assertEqual(sorted(Vote.objects.filter(fingerprint='voter')
+            .values_list('choice', flat=True)),
+            [self.choice1.id, self.choice2.id])
+
+    def test_view_logs_fingerprint(self):
+        """
+        Test that a vote through the view is logged with a fingerprint
+        """
+        self.client.post(reverse('polls:detail', args=(self.poll.id,)),
+            {'choice': [self.choice1.id]})
+        vote = Vote.objects.get()
+        self.assertEqual(len(vote.fingerprint), 40)
+
+    def test_rebuild(self):
+        """
+        Test that rebuild() recounts the votes from the log
+        """
+        self.vote(self.choice1, self.choice2)
+        self.vote(self.choice1)
+        Choice.objects.update(votes=100)
+        Vote.objects.rebuild(self.poll)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 2)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 1)
+
+    def test_prune_keeps_counts(self):
+        """
+        Test that pruned votes still count when rebuilding
+        """
+        self.vote(self.choice1)
+        Vote.objects.update(
+            timestamp=timezone.now() - datetime.timedelta(days=30))
+        self.vote(self.choice1, self.choice2)
+        before = timezone.now() - datetime.timedelta(days=7)
+        self.assertEqual(Vote.objects.prune(before, chunk_size=1), 1)
+        self.assertEqual(Vote.objects.count(), 2)
+        Vote.objects.rebuild()
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 2)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 1)
+
+    def test_rebuild_takes_votes_off_shards(self):
+        """
+        Test that a rebuild counts the sharded votes once, and that
+        folding afterwards doesn't add them again
+        """
+        self.poll.vote_shards = 4
+        self.vote(self.choice1)
+        self.vote(self.choice1, self.choice2)
+        Vote.objects.rebuild(self.poll)
+        self.assertEqual(ChoiceShard.objects.filter(votes__gt=0).count(), 0)
+        ChoiceShard.objects.fold(self.poll)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 2)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 1)
+
+    def test_rebuild_keeps_generated_votes(self):
+        """
+        Test that rebuild() keeps the votes of generated polls,
+        which aren't in the log
+        """
+        generate(20, future=0, sparse=0)
+        counts = dict(Choice.objects.values_list('id', 'votes'))
+        self.vote(self.choice1)
+        Vote.objects.rebuild()
+        counts[self.choice1.id] += 1
+        self.assertEqual(dict(Choice.objects.values_list('id', 'votes')),
+            counts)
+
+
+@override_settings(POLLS_DEDUPE_VOTES=True)
+class DedupeTests(TestCase):
+    def setUp(self):
+        super(DedupeTests, self).setUp()
+        cache.clear()
+        dedupe.reset()
+        self.poll = create_poll(question="Once only", days=-1)
+        self.choice = Choice.objects.create(choice_text="One", poll=self.poll)
+        Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:detail', args=(self.poll.id,))
+
+    def vote(self):
+        return self.client.post(self.url, {'choice': self.choice.id},
+            follow=True)
+
+    def test_second_vote_is_not_counted(self):
+        """
+        Test that voting twice counts once and says why
+        """
+        self.vote()
+        response = self.vote()
+        self.assertContains(response, "already voted")
+        self.assertEqual(Choice.objects.get(id=self.choice.id).votes, 1)
+        self.assertEqual(Ballot.objects.count(), 1)
+
+    def test_repeat_vote_skips_the_database(self):
+        """
+        Test that a remembered voter is turned away
+        without trying to insert a ballot
+        """
+        self.vote()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {'choice': self.choice.id})
+        self.assertFalse(statements(queries, 'INSERT'))
+
+    def test_unique_index_when_forgotten(self):
+        """
+        Test that the database still stops a voter the caches forgot
+        """
+        self.vote()
+        cache.clear()
+        dedupe.reset()
+        self.vote()
+        self.assertEqual(Choice.objects.get(id=self.choice.id).votes, 1)
+
+    def test_other_voters(self):
+        """
+        Test that different voters can all vote
+        """
+        self.vote()
+        self.client.post(self.url, {'choice': self.choice.id},
+            REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(Choice.objects.get(id=self.choice.id).votes, 2)
+
+    def test_lru_set_is_bounded(self):
+        """
+        Test that the LRU set forgets the least recently used entries
+        """
+        seen = dedupe.LRUSet(2)
+        seen.add('a')
+        seen.add('b')
+        self.assertTrue('a' in seen)
+        seen.add('c')
+        self.assertEqual(len(seen), 2)
+        self.assertFalse('b' in seen)
+        self.assertTrue('a' in seen)
+
+
+class BrokenCache(object):
+    def get_many(self, keys):
+        raise IOError("cache is down")
+
+
+@override_settings(POLLS_RATE_LIMIT_CLIENT=(2, 60),
+    POLLS_RATE_LIMIT_POLL=(3, 60))
+class RateLimitTests(TestCase):
+    def setUp(self):
+        super(RateLimitTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Limited", days=-1)
+        self.choice = Choice.objects.create(choice_text="One", poll=self.poll)
+        Choice.objects.create(choice_text="Two", poll=self.poll)
+        self.url = reverse('polls:detail', args=(self.poll.id,))
+
+    def vote(self, ip='127.0.0.1'):
+        return self.client.post(self.url, {'choice': self.choice.id},
+            REMOTE_ADDR=ip)
+
+    def test_client_limit(self):
+        """
+        Test that a client over its limit gets a 429 with Retry-After
+        and that other clients and GETs are not affected
+        """
+        self.assertEqual(self.vote().status_code, 302)
+        self.assertEqual(self.vote().status_code, 302)
+        response = self.vote()
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response['Retry-After']) <= 30)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.vote('10.0.0.1').status_code, 302)
+        self.assertEqual(Choice.objects.get(id=self.choice.id).votes, 3)
+
+    def test_poll_limit(self):
+        """
+        Test that a poll over its limit refuses every client
+        """
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            self.assertEqual(self.vote(ip).status_code, 302)
+        self.assertEqual(self.vote('10.0.0.4').status_code, 429)
+
+    def test_results_page_takes_no_votes(self):
+        """
+        Test that a client over its limit can't vote on the results
+        page instead
+        """
+        self.vote()
+        self.vote()
+        self.assertEqual(self.vote().status_code, 429)
+        response = self.client.post(
+            reverse('polls:results', args=(self.poll.id,)),
+            {'choice': self.choice.id})
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(Choice.objects.get(id=self.choice.id).votes, 2)
+
+    def test_buckets_refill(self):
+        """
+        Test that a bucket refills over its period
+        """
+        buckets = TokenBuckets()
+        limits = {'test:bucket': (2, 60)}
+        self.assertEqual(buckets.take(limits, now=1000), 0)
+        self.assertEqual(buckets.take(limits, now=1000), 0)
+        self.assertEqual(buckets.take(limits, now=1000), 30)
+        self.assertEqual(buckets.take(limits, now=1030), 0)
+
+    def test_local_fallback(self):
+        """
+        Test that the buckets still work when the cache is down
+        """
+        buckets = TokenBuckets()
+        buckets._cache = BrokenCache()
+        limits = {'test:bucket': (1, 60)}
+        self.assertEqual(buckets.take(limits, now=1000), 0)
+        self.assertEqual(buckets.take(limits, now=1000), 60)
+
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        super(RequestTimingTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Timed", days=-1)
+        assign_two_choices(self.poll)
+        self.handler = ListHandler()
+        logging.getLogger('mysite.log').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('mysite.log').removeHandler(self.handler)
+        super(RequestTimingTests, self).tearDown()
+
+    @override_settings(POLLS_TIMING_SAMPLE_RATE=1)
+    def test_sampled_request(self):
+        """
+        Test that a sampled request gets a Server-Timing header and a
+        JSON log line with its view and queries
+        """
+        response = self.client.get(
+            reverse('polls:results', args=(self.poll.id,)))
+        self.assertTrue(response['Server-Timing'].startswith('db;dur='))
+        self.assertTrue('render;dur=' in response['Server-Timing'])
+        stats = json.loads(self.handler.messages[-1])
+        self.assertEqual(stats['view'], 'polls:results')
+        self.assertEqual(stats['status'], 200)
+        self.assertTrue(stats['queries'] > 0)
+        self.assertTrue(stats['total'] >= stats['render'])
+
+    @override_settings(POLLS_TIMING_SAMPLE_RATE=0)
+    def test_unsampled_request(self):
+        """
+        Test that requests outside the sample are left alone
+        """
+        response = self.client.get(reverse('polls:index'))
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(self.handler.messages, [])
+
+
 #test status_code == 302 when valid form
 class PollFormTests(TestCase):
     def setUp(self):
@@ -523,6 +1692,16 @@ class PollFormTests(TestCase):
         self.assertRaises(KeyError, PollForm)
         self.assertRaises(KeyError, PollForm, {})
 
+    def test_zero_choice_id(self):
+        """
+        Test that a choice id of 0 is an invalid choice, not an error
+        """
+        form = PollForm({'choice': 0}, instance=self.poll_1)
+        self.assertFalse(form.is_valid())
+        form = PollForm({'choice': [0, self.choice_31.id]},
+            instance=self.multi_answer_poll)
+        self.assertFalse(form.is_valid())
+
     def test_save(self):
         """
         Test that saving with max_answer=1 works
@@ -588,6 +1767,18 @@ class PollFormTests(TestCase):
         self.assertEqual(choice2.votes, 1)
         self.assertEqual(choice3.votes, 0)
 
+    def test_save_with_multiple_answers_is_one_update(self):
+        """
+        Test that all the selected choices are counted with a single UPDATE
+        """
+        form = PollForm(
+            {'choice': [self.choice_31.id, self.choice_32.id]},
+            instance=self.multi_answer_poll)
+        self.assertTrue(form.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            form.save()
+        self.assertEqual(len(statements(queries, 'UPDATE')), 1)
+
     def test_save_with_one_answer_for_multi_answer_poll(self):
         """
         Test that you can still save with data for 1 choice when max_answers=2
@@ -645,6 +1836,338 @@ class PollFormTests(TestCase):
         self.assertEqual(choice2.votes, 0)
         self.assertEqual(choice3.votes, 0)
 
+
+class ShardedVoteTests(TestCase):
+    def setUp(self):
+        super(ShardedVoteTests, self).setUp()
+        self.poll = Poll.objects.create(
+            question="Hot poll", pub_date=timezone.now(),
+            max_answers=2, vote_shards=4)
+        self.choice1 = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.choice2 = Choice.objects.create(choice_text="Two", poll=self.poll)
+
+    def vote(self, times):
+        for i in range(times):
+            form = PollForm({'choice': [self.choice1.id, self.choice2.id]},
+                instance=self.poll)
+            form.save()
+
+    def test_votes_go_to_shards(self):
+        """
+        Test that a sharded poll counts votes in the shards
+        and not on the choice rows
+        """
+        self.vote(20)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 0)
+        shards = ChoiceShard.objects.filter(choice=self.choice1)
+        self.assertTrue(1 <= shards.count() <= 4)
+        self.assertEqual(sum(s.votes for s in shards), 20)
+
+    def test_fold(self):
+        """
+        Test that folding moves every shard vote into Choice.votes
+        """
+        self.vote(20)
+        self.assertEqual(ChoiceShard.objects.fold(), 40)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 20)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 20)
+        self.assertFalse(ChoiceShard.objects.filter(votes__gt=0).exists())
+        self.vote(1)
+        ChoiceShard.objects.fold(self.poll)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 21)
+
+    def test_unsharded_poll(self):
+        """
+        Test that a poll with one shard still counts on the choice
+        """
+        self.poll.vote_shards = 1
+        self.vote(1)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 1)
+        self.assertFalse(ChoiceShard.objects.exists())
+
+
+@override_settings(POLLS_VOTE_BUFFER=True, POLLS_VOTE_BUFFER_SIZE=100,
+    POLLS_VOTE_BUFFER_INTERVAL=3600, POLLS_VOTE_BUFFER_SINGLE_PROCESS=True)
+class VoteBufferTests(TestCase):
+    def setUp(self):
+        super(VoteBufferTests, self).setUp()
+        cache.clear()
+        self.poll = create_poll(question="Buffered", days=-1)
+        self.choice1 = Choice.objects.create(choice_text="One", poll=self.poll)
+        self.choice2 = Choice.objects.create(choice_text="Two", poll=self.poll)
+
+    def vote(self, choice):
+        return self.client.post(
+            reverse('polls:detail', args=(self.poll.id,)),
+            {'choice': choice.id})
+
+    def test_vote_is_buffered(self):
+        """
+        Test that a posted vote waits in the buffer until it is flushed
+        """
+        response = self.vote(self.choice1)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 0)
+        self.assertEqual(vote_buffer.pending(), 1)
+        self.assertEqual(vote_buffer.flush(), 1)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 1)
+        self.assertEqual(vote_buffer.pending(), 0)
+
+    def test_flush_when_full(self):
+        """
+        Test that the buffer flushes itself at POLLS_VOTE_BUFFER_SIZE votes
+        """
+        with self.settings(POLLS_VOTE_BUFFER_SIZE=3):
+            self.vote(self.choice1)
+            self.vote(self.choice2)
+            self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 0)
+            self.vote(self.choice1)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 2)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 1)
+
+    def test_retried_flush_is_not_counted_twice(self):
+        """
+        Test that a flush that crashed after committing
+        does not add the same votes again when it is retried
+        """
+        self.vote(self.choice1)
+        self.vote(self.choice1)
+        saved = cache.get_many([vote_buffer._vote_key(1),
+            vote_buffer._vote_key(2)])
+        vote_buffer.flush()
+        # put the cache back the way it was before the flush finished
+        cache.set_many(saved)
+        cache.set(vote_buffer.FLUSHED_KEY, 0)
+        cache.set(vote_buffer.CLAIMED_KEY, (1, 2))
+        self.assertEqual(vote_buffer.flush(), 0)
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 2)
+        self.assertEqual(vote_buffer.pending(), 0)
+
+    def test_flush_stops_at_unstored_vote(self):
+        """
+        Test that a flush doesn't pass a vote that was numbered
+        but not stored yet
+        """
+        self.vote(self.choice1)
+        # another process took number 2 and hasn't stored its vote
+        cache.incr(vote_buffer.SEQ_KEY)
+        self.vote(self.choice2)
+        self.assertEqual(vote_buffer.flush(), 1)
+        self.assertEqual(vote_buffer.pending(), 2)
+        cache.set(vote_buffer._vote_key(2), (self.poll.id, [self.choice2.id],
+            '', timezone.now()))
+        self.assertEqual(vote_buffer.flush(), 2)
+        self.assertEqual(Choice.objects.get(id=self.choice2.id).votes, 2)
+
+    def test_flush_is_outside_the_vote_transaction(self):
+        """
+        Test that a vote that fills the buffer flushes it after the
+        vote's own transaction is over
+        """
+        depths = []
+        flush = vote_buffer.flush
+
+        def recording_flush():
+            depths.append(len(connection.savepoint_ids))
+            return flush()
+        vote_buffer.flush = recording_flush
+        try:
+            with self.settings(POLLS_VOTE_BUFFER_SIZE=1):
+                self.vote(self.choice1)
+        finally:
+            vote_buffer.flush = flush
+        self.assertEqual(depths, [len(connection.savepoint_ids)])
+        self.assertEqual(Choice.objects.get(id=self.choice1.id).votes, 1)
+
+    def test_unsafe_caches_are_refused(self):
+        """
+        Test that the buffer won't run in a cache other processes can't
+        see or whose incr() isn't atomic
+        """
+        from django.core.cache import get_cache
+        from django.core.exceptions import ImproperlyConfigured
+        with self.settings(POLLS_VOTE_BUFFER_SINGLE_PROCESS=False):
+            self.assertRaises(ImproperlyConfigured, vote_buffer.enabled)
+        shared = vote_buffer.cache
+        vote_buffer.cache = get_cache(
+            'django.core.cache.backends.filebased.FileBasedCache',
+            LOCATION=tempfile.gettempdir())
+        try:
+            self.assertRaises(ImproperlyConfigured, vote_buffer.enabled)
+        finally:
+            vote_buffer.cache = shared
+
+
+class ConcurrentVoteTests(TransactionTestCase):
+    writers = 10
+
+    @skipIf(connection.vendor == 'sqlite' and
+        not connection.settings_dict.get('TEST_NAME'),
+        "the sqlite test database is in memory and not shared by threads")
+    def test_parallel_writers_lose_no_votes(self):
+        """
+        Test that every vote is counted when many requests save at once
+        """
+        poll = Poll.objects.create(
+            question="Concurrent", pub_date=timezone.now(), max_answers=2)
+        choice1 = Choice.objects.create(choice_text="One", poll=poll)
+        choice2 = Choice.objects.create(choice_text="Two", poll=poll)
+        start = threading.Event()
+
+        def vote():
+            try:
+                form = PollForm(
+                    {'choice': [choice1.id, choice2.id]}, instance=poll)
+                form.is_valid()
+                start.wait()
+                form.save()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote) for i in range(self.writers)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Choice.objects.get(id=choice1.id).votes, self.writers)
+        self.assertEqual(Choice.objects.get(id=choice2.id).votes, self.writers)
+
+class ReplicaRouterTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(ReplicaRouterTests, cls).setUpClass()
+        # a second SQLite file that nothing is copied to, like a replica
+        # that is far behind
+        settings.DATABASES['replica'] = dict(settings.DATABASES['default'],
+            TEST_NAME=os.path.join(tempfile.gettempdir(), 'polls_replica.db'))
+        cls.replica_name = connections['replica'].creation.create_test_db(
+            verbosity=0, autoclobber=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].creation.destroy_test_db(
+            cls.replica_name, verbosity=0)
+        connections['replica'].close()
+        del settings.DATABASES['replica']
+        super(ReplicaRouterTests, cls).tearDownClass()
+
+    def setUp(self):
+        super(ReplicaRouterTests, self).setUp()
+        cache.clear()
+        self.router = ReplicaRouter()
+
+    @override_settings(POLLS_READ_REPLICAS=('replica',))
+    def test_reads(self):
+        """
+        Test that polls reads go to the replicas, except when pinned,
+        inside a transaction or for other apps
+        """
+        self.assertEqual(self.router.db_for_read(Poll), 'replica')
+        self.assertEqual(self.router.db_for_read(Choice), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_write(Choice), 'default')
+        with routers.primary():
+            self.assertEqual(self.router.db_for_read(Poll), None)
+        with transaction.atomic():
+            self.assertEqual(self.router.db_for_read(Poll), None)
+        self.assertEqual(self.router.db_for_read(Poll), 'replica')
+
+    def test_no_replicas(self):
+        self.assertEqual(self.router.db_for_read(Poll), None)
+
+    @override_settings(POLLS_READ_REPLICAS=('replica',))
+    def test_cached_reads_use_primary(self):
+        """
+        Test that what is cached under a version is read from the
+        primary even if the replica hasn't got it yet
+        """
+        poll = create_poll(question="Replicated", days=-1)
+        assign_two_choices(poll)
+        self.assertFalse(Poll.objects.filter(pk=poll.pk).exists())
+        self.assertContains(self.client.get(reverse('polls:index')),
+            "Replicated")
+        self.assertContains(self.client.get(
+            reverse('polls:detail', args=(poll.id,))), "choice one")
+        self.assertContains(self.client.get(
+            reverse('polls:results', args=(poll.id,))), "choice two")
+        response = self.client.get(
+            reverse('polls:results_json', args=(poll.id,)))
+        self.assertEqual(json.loads(response.content)['id'], poll.id)
+        self.assertEqual(json.loads(live.results_payload(poll))['id'],
+            poll.id)
+
+    @override_settings(POLLS_READ_REPLICAS=('replica',),
+        POLLS_RATE_LIMIT_CLIENT=None, POLLS_RATE_LIMIT_POLL=None)
+    def test_sticky_after_vote(self):
+        """
+        Test that a vote sets the cookie that pins the voter's next
+        requests to the primary
+        """
+        poll = create_poll(question="Replicated", days=-1)
+        assign_two_choices(poll)
+        with routers.primary():
+            choice = poll.choices.all()[0]
+        response = self.client.post(reverse('polls:detail', args=(poll.id,)),
+            {'choice': choice.id})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue('polls_primary' in response.cookies)
+        request = RequestFactory().get('/')
+        request.COOKIES['polls_primary'] = '1'
+        middleware = ReplicaPinMiddleware()
+        middleware.process_request(request)
+        self.assertTrue(routers.pinned())
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(routers.pinned())
+
+
+class GeneratePollsTests(TestCase):
+    def test_generate(self):
+        """
+        Test that generated polls have the choices their choice_count
+        says, including some future and sparse ones
+        """
+        added = generate(200, chunk_size=60, seed=1, future=0.2, sparse=0.2)
+        self.assertEqual(Poll.objects.count(), 200)
+        self.assertEqual(Choice.objects.count(), added)
+        for poll in Poll.objects.annotate(num_choices=Count('choices')):
+            self.assertEqual(poll.choice_count, poll.num_choices)
+        self.assertTrue(Poll.objects.filter(pub_date__gt=timezone.now()))
+        self.assertTrue(Poll.objects.filter(choice_count__lt=2))
+        published = Poll.objects.published().count()
+        self.assertTrue(0 < published < 200)
+
+    def test_seed(self):
+        """
+        Test that the same seed gives the same polls
+        """
+        generate(20, seed=3)
+        first = list(Choice.objects.order_by('id').values_list('votes'))
+        Poll.objects.all().delete()
+        generate(20, seed=3)
+        self.assertEqual(
+            list(Choice.objects.order_by('id').values_list('votes')), first)
+        # new rows still get ids after the generated ones
+        poll = create_poll(question="After", days=-1)
+        self.assertEqual(poll.id, Poll.objects.order_by('-id')[0].id)
+
+
+@skipIf(connection.vendor != 'sqlite', "SQLite only")
+class SQLitePragmaTests(TestCase):
+    def test_pragmas(self):
+        """
+        Test that POLLS_SQLITE_PRAGMAS are run on new connections
+        """
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA busy_timeout')
+        old = cursor.fetchone()[0]
+        with self.settings(POLLS_SQLITE_PRAGMAS=(('busy_timeout', 1234),)):
+            configure_sqlite(sender=None, connection=connection)
+        cursor.execute('PRAGMA busy_timeout')
+        self.assertEqual(cursor.fetchone()[0], 1234)
+        cursor.execute('PRAGMA busy_timeout = %s' % old)
+
+
 '''
 class BrowserPollFormTests(LiveServerTestCase):
     def setUp(self):
@@ -4,7 +4,17 @@ from polls import views
 
 urlpatterns = patterns('',
     url(r'^$', views.IndexView.as_view(), name='index'),
+    url(r'^archive/$', views.ArchiveView.as_view(), name='archive'),
+    url(r'^archive\.json$', views.ArchiveJSONView.as_view(),
+        name='archive_json'),
+    url(r'^votes/import$', views.import_votes, name='import_votes'),
     url(r'^(?P<pk>\d+)/$', views.DetailView.as_view(), name='detail'),
     url(r'^(?P<pk>\d+)/results/$', views.ResultsView.as_view(), name='results'),
+    url(r'^(?P<pk>\d+)/results\.json$', views.ResultsJSONView.as_view(),
+        name='results_json'),
+    url(r'^(?P<pk>\d+)/results/stream$', views.ResultsStreamView.as_view(),
+        name='results_stream'),
+    url(r'^(?P<pk>\d+)/comments/$', views.CommentsView.as_view(),
+        name='comments'),
     #url(r'^(?P<pk>\d+)/vote/$', views.VoteView.as_view(), name='vote'),
 )
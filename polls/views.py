@@ -1,20 +1,121 @@
+import json
 import logging
 logger = logging.getLogger('mysite.log')
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.contrib import messages
+from django.db import transaction
+from django.middleware.csrf import get_token
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.utils import timezone, translation
+from django.utils.translation import ugettext as _
+from django.http import (HttpResponse, HttpResponseRedirect, Http404,
+    StreamingHttpResponse)
 from django.views.generic import ListView, DetailView
-from django.views.generic.detail import SingleObjectMixin
+from django.views.generic.detail import (SingleObjectMixin, BaseDetailView,
+    SingleObjectTemplateResponseMixin)
+from django.views.decorators.http import etag, require_POST
+from django.contrib.auth.decorators import permission_required
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
 from polls.models import Poll
 from polls.forms import PollForm
+from polls.ingest import VoteImporter
+from polls import buffer as vote_buffer
+from polls import caching
+from polls import pagination
+from polls import live
+from polls import voters
+from polls import dedupe
+from polls import comments
+from polls import routers
 
 
-class PublishedPollMixin(object):
+class DuePollMixin(object):
+    """
+    Makes a scheduled poll live when it is looked up after its pub_date,
+    so its pages appear on time even if promote_polls hasn't run since
+    """
+
+    def get_object(self, queryset=None):
+        try:
+            return super(DuePollMixin, self).get_object(queryset)
+        except Http404:
+            pk = self.kwargs.get(self.pk_url_kwarg)
+            # most misses aren't due polls, they shouldn't each write
+            if not (Poll.objects.filter(pk=pk, state=Poll.SCHEDULED,
+                    pub_date__lte=timezone.now()).exists() and
+                    Poll.objects.promote(pk=pk)):
+                raise
+        # a replica may not have the new state yet
+        with routers.primary():
+            return super(DuePollMixin, self).get_object(queryset)
+
+
+class PublishedPollMixin(DuePollMixin):
     def get_queryset(self):
         #super(PublishedPollMixin, self).get_queryset()
         return self.model.objects.published()
 
 
+class ResultsPollMixin(DuePollMixin):
+    def get_queryset(self):
+        # closed polls come with their snapshot in the same query
+        return self.model.objects.with_results().select_related('snapshot')
+
+
+# stands in for the CSRF token in cached pages
+CSRF_PLACEHOLDER = 'pollscsrftokenplaceholder'
+
+
+class PageCacheMixin(object):
+    """
+    Serves GETs from a cache of the rendered page keyed on
+    ``page_cache_name``, the poll, the versions from ``page_versions()``
+    and the language. Cached pages carry a placeholder where the CSRF
+    token goes, each response gets the visitor's own token.
+    Requests with messages to show get a page of their own.
+    """
+    page_cache_name = None
+
+    def page_versions(self, pk, create=True):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        if len(messages.get_messages(request)):
+            return super(PageCacheMixin, self).get(request, *args, **kwargs)
+        if None in self.page_versions(kwargs['pk'], create=False):
+            # only start versions for a poll that is there
+            with routers.primary():
+                self.get_object()
+        key = caching.page_key(self.page_cache_name, kwargs['pk'],
+            self.page_versions(kwargs['pk']), translation.get_language())
+        content = cache.get(key)
+        caching.count_page(self.page_cache_name, content is not None)
+        if content is not None:
+            return self.insert_csrf_token(HttpResponse(content))
+        # the page is cached under the versions, read what they stand for
+        with routers.primary():
+            response = super(PageCacheMixin, self).get(
+                request, *args, **kwargs)
+        token = request.META.get('CSRF_COOKIE')
+        request.META['CSRF_COOKIE'] = CSRF_PLACEHOLDER
+
+        def store(response):
+            request.META['CSRF_COOKIE'] = token
+            cache.set(key, response.content,
+                getattr(settings, 'POLLS_PAGE_CACHE_TIMEOUT', 3600))
+            return self.insert_csrf_token(response)
+        response.add_post_render_callback(store)
+        return response
+
+    def insert_csrf_token(self, response):
+        response.content = response.content.replace(
+            CSRF_PLACEHOLDER, get_token(self.request))
+        return response
+
+
 class PollFormMixin(SingleObjectMixin):
     """
     puts form and "view results link" in context
@@ -24,18 +125,34 @@ class PollFormMixin(SingleObjectMixin):
 
     def get_context_data(self, **kwargs):
         context = super(PollFormMixin, self).get_context_data(**kwargs)
-        form = PollForm(instance=self.get_object())
+        form = PollForm(instance=self.object)
         context['form'] = form
         return context
 
     def post(self, request, *args, **kwargs):
-        form = PollForm(request.POST, instance=self.get_object())
+        # look the poll up once and reuse it for the rest of the request
+        self.object = self.get_object()
+        form = PollForm(request.POST, instance=self.object)
         if form.is_valid():
-            form.save()
+            fingerprint = voters.fingerprint(request)
+            buffered = vote_buffer.enabled()
+            with transaction.atomic():
+                if dedupe.enabled() and not dedupe.claim(
+                        self.object, fingerprint):
+                    messages.info(request,
+                        _("You have already voted on this poll."))
+                    return HttpResponseRedirect(self.success_url)
+                if not buffered:
+                    form.save(fingerprint)
+            # a buffer that is full flushes, in a transaction of its own
+            if buffered:
+                form.buffer(fingerprint)
+            if dedupe.enabled():
+                dedupe.remember(self.object.pk, fingerprint)
             return HttpResponseRedirect(self.success_url)
         else:
             return render(request, self.template_name,
-                {'form': form, 'poll': self.get_object()})
+                {'form': form, 'poll': self.object})
 
 
 class IndexView(PublishedPollMixin, ListView):
@@ -52,25 +169,235 @@ class IndexView(PublishedPollMixin, ListView):
         Return the last five published polls
         (not including those with one choice or set to be
         published in the future).
+        The list is cached until a poll or choice changes
+        or the next scheduled poll is published.
         """
+        polls, self.next_cursor = caching.get('index', self.latest_polls)
+        return polls
+
+    def latest_polls(self):
+        # the cache expires when the next poll opens or closes, so the
+        # index is right even if promote_polls hasn't run yet
+        Poll.objects.promote()
+        Poll.objects.close_due()
         qs = super(IndexView, self).get_queryset()
-        return qs[:5]
+        changes = [date for date in (Poll.objects.next_publication(),
+            Poll.objects.next_closing()) if date is not None]
+        return (pagination.page(qs, per_page=5),
+            min(changes) if changes else None)
         #return Poll.objects.published()[:5]
 
+    def get_context_data(self, **kwargs):
+        context = super(IndexView, self).get_context_data(**kwargs)
+        context['index_version'] = caching.version('index')
+        context['next_cursor'] = self.next_cursor
+        return context
+
 
-class DetailView(PublishedPollMixin, PollFormMixin, DetailView):
+class ArchiveView(PublishedPollMixin, ListView):
+    """
+    All published polls, newest first, a page at a time.
+    ``?after=<cursor>`` starts the page after the poll the cursor
+    points at, so older pages cost the same as the first.
+    """
+    model = Poll
+    template_name = 'polls/archive.html'
+    context_object_name = 'poll_list'
+    per_page = 20
+
+    def get_queryset(self):
+        qs = super(ArchiveView, self).get_queryset()
+        try:
+            polls, self.next_cursor = pagination.page(
+                qs, self.request.GET.get('after'), self.per_page)
+        except pagination.InvalidCursor:
+            raise Http404
+        return polls
+
+    def get_context_data(self, **kwargs):
+        context = super(ArchiveView, self).get_context_data(**kwargs)
+        context['next_cursor'] = self.next_cursor
+        return context
+
+
+class ArchiveJSONView(ArchiveView):
+    """
+    ArchiveView as JSON
+    """
+
+    def render_to_response(self, context, **response_kwargs):
+        data = {
+            'polls': [{
+                'id': poll.id,
+                'question': poll.question,
+                'pub_date': poll.pub_date.isoformat(),
+                'url': reverse('polls:detail', args=(poll.id,)),
+            } for poll in context['poll_list']],
+            'next': context['next_cursor'],
+        }
+        return HttpResponse(json.dumps(data),
+            content_type='application/json', **response_kwargs)
+
+
+class DetailView(PageCacheMixin, PublishedPollMixin, PollFormMixin,
+        DetailView):
     """
     Vote on a poll
     """
     model = Poll
     template_name = 'polls/detail.html'
+    page_cache_name = 'page:detail'
+
+    def page_versions(self, pk, create=True):
+        # votes don't change the form
+        return [caching.version(caching.choices(pk), create)]
 
     @property
     def success_url(self):
         return reverse(
-            'polls:results', args=(self.get_object().id,))
+            'polls:results', args=(self.object.id,))
 
 
-class ResultsView(DetailView):
+class ResultsView(ResultsPollMixin, DetailView):
     model = Poll
     template_name = 'polls/results.html'
+    page_cache_name = 'page:results'
+    # votes go to DetailView, which only takes them for published polls
+    http_method_names = ['get', 'head']
+
+    def page_versions(self, pk, create=True):
+        return [caching.version(caching.poll(pk), create),
+            caching.version(caching.comments(pk), create)]
+
+    def get_context_data(self, **kwargs):
+        # the results page has no form
+        context = super(PollFormMixin, self).get_context_data(**kwargs)
+        snapshot = self.object.frozen_results()
+        if snapshot is not None:
+            context['choices'] = snapshot.choice_list()
+            context['total_votes'] = snapshot.total_votes
+        else:
+            context['choices'], context['total_votes'] = \
+                self.object.results()
+        context['comment_count'] = comments.count(self.object)
+        context.update(comments_context(self.object))
+        return context
+
+
+class CommentsView(ResultsPollMixin, SingleObjectTemplateResponseMixin,
+        BaseDetailView):
+    """
+    A page of comments, fetched by the "Older comments" link
+    """
+    model = Poll
+    template_name = 'polls/comments.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(CommentsView, self).get_context_data(**kwargs)
+        try:
+            number = int(self.request.GET.get('page', 1))
+        except ValueError:
+            raise Http404
+        if number < 1:
+            raise Http404
+        context.update(comments_context(self.object, number))
+        return context
+
+
+def comments_context(poll, number=1):
+    return {
+        'comment_page': comments.page(poll, number),
+        'comment_page_number': number,
+        'comments_version': caching.version(caching.comments(poll.pk)),
+    }
+
+
+def results_etag(request, pk):
+    return '%s-%s' % (pk, caching.version(caching.poll(pk)))
+
+
+class ResultsJSONView(ResultsPollMixin, BaseDetailView):
+    """
+    Vote counts for dashboards that poll often, the final counts once
+    the poll is closed.
+    The ETag moves on with every counted vote, so a client that sends
+    back an unchanged ETag gets a 304 before the poll is even looked up.
+
+    With ``?wait=<seconds>`` a request with an unchanged ETag is held
+    until votes are counted or the time is up (long polling). Serve it
+    from ``mysite.green`` so waiting requests don't take a thread each.
+    """
+    model = Poll
+
+    def dispatch(self, request, *args, **kwargs):
+        if caching.version(caching.poll(kwargs['pk']), create=False) is None:
+            # only start a version for a poll that is there
+            with routers.primary():
+                self.get_object()
+        self.wait_for_votes(request, kwargs['pk'])
+        return self.etag_dispatch(request, *args, **kwargs)
+
+    @method_decorator(etag(results_etag))
+    def etag_dispatch(self, request, *args, **kwargs):
+        # clients keep the response under the ETag's version
+        with routers.primary():
+            return super(ResultsJSONView, self).dispatch(
+                request, *args, **kwargs)
+
+    def wait_for_votes(self, request, pk):
+        try:
+            timeout = min(float(request.GET['wait']),
+                getattr(settings, 'POLLS_LONG_POLL_TIMEOUT', 30))
+        except (KeyError, ValueError):
+            return
+        if timeout <= 0:
+            return
+        version = caching.version(caching.poll(pk))
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if '%s-%s' % (pk, version) in etags:
+            live.get_broker().wait(int(pk), version, timeout)
+
+    def render_to_response(self, context, **response_kwargs):
+        poll = self.object
+        choices, total_votes = poll.final_results()
+        data = {
+            'id': poll.id,
+            'question': poll.question,
+            'total_votes': total_votes,
+            'choices': choices,
+        }
+        return HttpResponse(json.dumps(data),
+            content_type='application/json', **response_kwargs)
+
+
+class ResultsStreamView(ResultsPollMixin, BaseDetailView):
+    """
+    Server-Sent Events with the results every time votes are counted,
+    see ``polls.live``
+    """
+    model = Poll
+
+    def render_to_response(self, context, **response_kwargs):
+        try:
+            last_version = int(self.request.META['HTTP_LAST_EVENT_ID'])
+        except (KeyError, ValueError):
+            last_version = None
+        response = StreamingHttpResponse(
+            live.stream(self.object, last_version),
+            content_type='text/event-stream', **response_kwargs)
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+@require_POST
+@permission_required('polls.change_choice', raise_exception=True)
+def import_votes(request):
+    """
+    Imports the ballots in the request body, newline delimited JSON
+    or CSV (``Content-Type: text/csv``), see ``polls.ingest``
+    """
+    content_type = request.META.get('CONTENT_TYPE', '')
+    format = 'csv' if content_type.startswith('text/csv') else 'ndjson'
+    source = ('import:%s' % request.user.get_username())[:40]
+    report = VoteImporter(source=source).run(request, format)
+    return HttpResponse(json.dumps(report), content_type='application/json')
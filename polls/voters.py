@@ -0,0 +1,21 @@
+"""
+Telling voters apart without storing who they are
+"""
+from django.utils.crypto import salted_hmac
+
+
+def fingerprint(request):
+    """
+    A keyed hash of the user if they are logged in, otherwise of their
+    session, otherwise of their IP address and user agent
+    """
+    user = getattr(request, 'user', None)
+    session = getattr(request, 'session', None)
+    if user is not None and user.is_authenticated():
+        key = 'user:%s' % user.pk
+    elif session is not None and session.session_key:
+        key = 'session:%s' % session.session_key
+    else:
+        key = 'ip:%s:%s' % (request.META.get('REMOTE_ADDR', ''),
+            request.META.get('HTTP_USER_AGENT', ''))
+    return salted_hmac('polls.voters.fingerprint', key).hexdigest()